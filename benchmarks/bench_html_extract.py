@@ -0,0 +1,120 @@
+"""Benchmark the lxml extraction layer against the original BeautifulSoup scrapers.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_html_extract {nasa,wikipedia} [pages_dir] [--repeat N]
+
+pages_dir holds saved article pages (*.html) of the chosen kind, e.g. from
+curl -o; without it the small built-in pages are used. Besides timings, the
+share of pages where both extractors return the same fields is reported.
+"""
+import os
+import sys
+import time
+import argparse
+from bs4 import BeautifulSoup
+from scripts import html_extract
+
+# Built-in pages per kind, the last one with non-ASCII text and no declared charset
+SAMPLE_PAGES = {
+    "nasa": ["""<html><body><h1> Heat Wave <em>in</em> Europe </h1>
+<p class="date">Published Jul 19, 2022</p>
+<a href="/topic/heat">Heat</a> <a href="/topic/atmosphere">Atmosphere</a> <a href="/topic/water">Water</a>
+<figure><img src="/preview.jpg" alt="Land surface temperatures over Europe"></figure>
+<a href="https://eoimages.gsfc.nasa.gov/heat.jpg">JPEG</a> <a href="https://eoimages.gsfc.nasa.gov/heat.tif">GeoTIFF</a>
+</body></html>""", """<html><body><h1>Canicule sur l’Île-de-France – 40 °C</h1>
+<p class="date">Published Jul 19, 2022</p>
+<a href="/topic/heat">Heat</a> <a href="/topic/atmosphère">Atmosphère</a>
+<figure><img src="/preview.jpg" alt="Températures de surface à Zürich, São Paulo et Kraków"></figure>
+<a href="https://eoimages.gsfc.nasa.gov/chaleur.png">PNG</a>
+</body></html>"""],
+    "wikipedia": ["""<html><body><div class="mw-parser-output">
+<figure class="mw-default-size"><a href="/wiki/File:Solar.jpg"><img src="//upload.wikimedia.org/wikipedia/commons/thumb/a/ab/Solar.jpg/220px-Solar.jpg" data-file-width="4000" data-file-height="3000"></a>
+<figcaption>Solar panels <b>on</b> a roof</figcaption></figure>
+<div class="thumb tright"><div class="thumbinner"><img src="/static/Wind.png" srcset="/static/Wind.png 1.5x">
+<div class="thumbcaption">Wind <!-- note --> farm</div></div></div>
+</div></body></html>""", """<html><body><div class="mw-parser-output">
+<figure><a href="/wiki/File:Kraków.jpg"><img src="//upload.wikimedia.org/wikipedia/commons/thumb/c/c3/Kraków.jpg/250px-Kraków.jpg" alt="Kraków – Rynek Główny"></a>
+<figcaption>Solar roofs in Kraków’s Rynek Główny, 2019 — ≈ 5 MWp</figcaption></figure>
+<div class="thumb tleft"><div class="thumbinner"><img src="/static/Éolienne.png">
+<div class="thumbcaption">Éoliennes près de Zürich</div></div></div>
+</div></body></html>"""]
+}
+
+def baseline_nasa(content):
+    # The original nasa_retrieval.download_nasa_image parsing
+    soup = BeautifulSoup(content, "html.parser")
+    title_tag = soup.find("h1")
+    pub_date_tag = soup.find(lambda tag: tag.name == "p" and "Published" in tag.text)
+    image_link_tag = soup.find("a", string=["JPEG", "PNG"])
+    caption_tag = soup.find("img", alt=True)
+    return {
+        "title": title_tag.get_text(strip=True) if title_tag else "untitled",
+        "published": pub_date_tag.text.replace("Published", "").strip() if pub_date_tag else None,
+        "topics": [tag.text.strip().lower() for tag in soup.find_all("a", href=lambda h: h and '/topic/' in h)],
+        "image_url": image_link_tag.get("href") if image_link_tag else None,
+        "caption": caption_tag["alt"] if caption_tag else ""
+    }
+
+def baseline_wikipedia(content):
+    # The original wikipedia_images_retrieval.get_article_images_with_captions parsing
+    soup = BeautifulSoup(content, "html.parser")
+    figures = []
+    for figure in soup.select('.mw-parser-output figure, .mw-parser-output div.thumb'):
+        img_tag = figure.find('img')
+        if not img_tag:
+            continue
+        caption_tag = figure.find('figcaption') or figure.find('div', class_='thumbcaption')
+        caption = caption_tag.get_text(strip=True) if caption_tag else ""
+        attrs = {key: " ".join(value) if isinstance(value, list) else value for key, value in img_tag.attrs.items()}
+        figures.append((attrs, caption))
+    return figures
+
+EXTRACTORS = {
+    "nasa": (baseline_nasa, html_extract.nasa_article),
+    "wikipedia": (baseline_wikipedia, html_extract.wikipedia_figures)
+}
+
+def load_pages(kind, pages_dir):
+    if not pages_dir:
+        return [page.encode("utf-8") for page in SAMPLE_PAGES[kind]]
+    pages = []
+    for file in sorted(os.listdir(pages_dir)):
+        if file.endswith((".html", ".htm")):
+            with open(os.path.join(pages_dir, file), 'rb') as f:
+                pages.append(f.read())
+    return pages
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("kind", choices=sorted(EXTRACTORS), help="Scraper whose pages are benchmarked")
+    parser.add_argument("pages_dir", nargs="?", help="Directory of saved *.html pages")
+    parser.add_argument("--repeat", type=int, default=20, help="Times each page is extracted")
+    args = parser.parse_args()
+
+    pages = load_pages(args.kind, args.pages_dir)
+    if not pages:
+        print(f"No .html pages found in {args.pages_dir}")
+        return 1
+    baseline, extractor = EXTRACTORS[args.kind]
+    workload = pages * args.repeat
+    megabytes = sum(len(page) for page in workload) / 1024 ** 2
+
+    start = time.perf_counter()
+    expected = [baseline(page) for page in workload]
+    baseline_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extracted = [extractor(page) for page in workload]
+    extract_seconds = time.perf_counter() - start
+
+    agreement = sum(a == b for a, b in zip(expected, extracted)) / len(workload)
+    print(f"pages:             {len(workload)} ({len(pages)} distinct x {args.repeat}, {megabytes:.1f} MB)")
+    print(f"BeautifulSoup:     {baseline_seconds:.3f}s ({len(workload) / baseline_seconds:.0f} pages/s)")
+    print(f"html_extract:      {extract_seconds:.3f}s ({len(workload) / max(extract_seconds, 1e-9):.0f} pages/s)")
+    print(f"speed-up:          {baseline_seconds / max(extract_seconds, 1e-9):.1f}x")
+    print(f"agreement:         {agreement:.1%}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Benchmark the cached language filter against per-title langdetect calls.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_language_filter [titles.txt] [--repeat N]
+
+titles.txt holds one Commons file title per line; without it a built-in
+sample of typical titles is used.
+"""
+import sys
+import time
+import argparse
+from langdetect import detect, LangDetectException
+from scripts import language_filter
+
+SAMPLE_TITLES = [
+    "File:Solar panels on a roof.jpg",
+    "File:Wind turbines in the North Sea.jpg",
+    "File:IMG_1234.JPG",
+    "File:DSC01234.jpg",
+    "File:P1010001.JPG",
+    "File:20190712_101530.jpg",
+    "File:Windkraftanlage bei Husum.jpg",
+    "File:Centrale nucléaire de Cattenom.jpg",
+    "File:Parque eólico de Malpica.jpg",
+    "File:Hydroelectric power plant on the river.jpg",
+    "File:Substation transformer 02.jpg",
+    "File:Substation transformer 03.jpg",
+    "File:Smart meter installed in a house.png",
+    "File:Электростанция.jpg",
+    "File:Geothermal power plant at night.jpg",
+    "File:Photovoltaic array - aerial view.jpg",
+    "File:Fernwärme Leitung Wien.jpg",
+    "File:Heat pump outdoor unit.jpg",
+    "File:Coal-fired power plant chimney.jpg",
+    "File:Zonnepanelen op het dak.jpg",
+]
+
+def baseline_is_english(title):
+    # The original wikimedia_retrieval.is_english_title
+    try:
+        return detect(title) == "en"
+    except LangDetectException:
+        return False
+
+def load_titles(path):
+    if not path:
+        return SAMPLE_TITLES
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("titles", nargs="?", help="File with one title per line")
+    parser.add_argument("--repeat", type=int, default=50, help="Times the title list is classified")
+    args = parser.parse_args()
+
+    titles = load_titles(args.titles)
+    # Titles as download_image passes them: no "File:" prefix, separators as spaces
+    workload = [title.replace("File:", "").replace("_", " ").replace("-", " ") for title in titles] * args.repeat
+
+    start = time.perf_counter()
+    baseline = [baseline_is_english(title) for title in workload]
+    baseline_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filtered = language_filter.is_english_titles(workload)
+    filter_seconds = time.perf_counter() - start
+
+    agreement = sum(a == b for a, b in zip(baseline, filtered)) / len(workload)
+    print(f"titles:            {len(workload)} ({len(titles)} distinct x {args.repeat})")
+    print(f"langdetect:        {baseline_seconds:.3f}s ({len(workload) / baseline_seconds:.0f} titles/s)")
+    print(f"language_filter:   {filter_seconds:.3f}s ({len(workload) / max(filter_seconds, 1e-9):.0f} titles/s)")
+    print(f"speed-up:          {baseline_seconds / max(filter_seconds, 1e-9):.1f}x")
+    print(f"agreement:         {agreement:.1%}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,10 @@
 import os
+import time
 import logging
 from pathlib import Path
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from scripts import catalog, http_client, http_cache, job_ledger
 from scripts.copernicus_retrieval import download_copernicus_images
 from scripts.eprel_retrieval import download_eprel_labels
 from scripts.inria_retrieval import download_inria_images
@@ -8,6 +12,8 @@ from scripts.irf_retrieval import download_irf_images
 from scripts.nasa_retrieval import download_nasa_images
 from scripts.wikimedia_retrieval import download_wikimedia_images
 from scripts.wikipedia_images_retrieval import download_wikipedia_images
+from scripts.phash_index import dedupe_images
+from scripts.shards import pack_shards
 
 def configure_logging():
     logging.basicConfig(
@@ -19,161 +25,244 @@ def configure_logging():
         ]
     )
 
+WIKIMEDIA_CATEGORIES = [
+    "Satellite pictures", 
+    "Construction", 
+    "Power plants",
+    "Solar panels", 
+    "Wind turbines",
+    "Smart meters",
+    "Electric vehicles",
+    "Energy storage",
+    "Energy efficiency labels",
+    "Renewable energy",
+    "Energy transition",
+    "Energy infrastructure",
+    "Nuclear power plants",
+    "Hydroelectric power plants",
+    "Geothermal energy",   
+    "Biomass energy",
+    "Coal-fired power plants",
+    "Geothermal power plants",
+    "Biofuels",
+    "Power transmission lines",
+    "Smart grids",
+    "Substations",
+    "Control rooms of transmission systems",
+    "Energy monitoring systems",
+    "Energy management systems",
+    "Natural gas power plants",
+    "Zero energy buildings",
+    "Energy-efficient buildings",
+    "Near-zero energy buildings",
+    "Energy-efficient appliances",
+    "Energy-efficient lighting",
+    "Energy-efficient HVAC systems",
+    "Energy-efficient windows",
+    "smart home energy systems",
+    "microgrids",
+    "demand response systems",
+    "virtual power plants",
+    "carbon capture and storage",
+    "fuel cells",
+    "hydrogen energy systems",
+    "green roofs",
+    "solar thermal systems",
+    "energy-efficient transportation",
+    "energy-efficient industrial processes",
+    "energy-efficient manufacturing",
+    "district heating systems",
+    "district cooling systems",
+    "heat pumps",
+    "photovoltaic systems",
+]
+
+INRIA_CITIES = ["Austin", "Chicago", "Kitsap", "Western Tyrol", "Vienna", "Bellingham", "Bloomington", "Innsbruck", "San Francisco", "Eastern Tyrol"]
+
+def source_workers(source_name, max_workers):
+    # Per-source cap, never above the global cap
+    workers = int(os.getenv(f"{source_name.upper()}_WORKERS", 1))
+    return max(1, min(workers, max_workers))
+
+def run_copernicus(workers):
+    async_mode = os.getenv("COPERNICUS_ASYNC", "0") == "1"
+    max_concurrency = int(os.getenv("COPERNICUS_CONCURRENCY", 16))
+    per_host_limit = int(os.getenv("COPERNICUS_PER_HOST_LIMIT", 8))
+    resolution_m = float(os.getenv("COPERNICUS_RESOLUTION_M", 0)) or None
+    max_tile_size = int(os.getenv("COPERNICUS_MAX_TILE_SIZE", 4000))
+
+    return download_copernicus_images(output_dir="output/images/copernicus", max_workers=workers, async_mode=async_mode, max_concurrency=max_concurrency, per_host_limit=per_host_limit, resolution_m=resolution_m, max_tile_size=max_tile_size)
+
+def run_eprel(workers):
+    dpis = [int(dpi) for dpi in os.getenv("EPREL_DPIS", "200").split(",") if dpi.strip()]
+    render_workers = int(os.getenv("EPREL_RENDER_WORKERS", 0)) or None
+
+    discover = os.getenv("EPREL_DISCOVERY", "0") == "1"
+    categories = [category.strip() for category in os.getenv("EPREL_CATEGORIES", "").split(",") if category.strip()] or None
+    listing_url = os.getenv("EPREL_LISTING_URL", "https://eprel.ec.europa.eu/api/products")
+    listing_filters = dict(parse_qsl(os.getenv("EPREL_LISTING_FILTERS", "")))
+    max_products = int(os.getenv("EPREL_MAX_PRODUCTS", 0)) or None
+    api_key = os.getenv("EPREL_API_KEY") or None
+    queue_size = int(os.getenv("EPREL_QUEUE_SIZE", 100))
+    base_url = os.getenv("EPREL_LABEL_URL", "https://eprel.ec.europa.eu/labels")
+
+    return download_eprel_labels(output_dir="output/images/eprel", max_workers=workers, dpis=dpis, render_workers=render_workers, discover=discover, categories=categories, listing_url=listing_url, listing_filters=listing_filters, max_products=max_products, api_key=api_key, queue_size=queue_size, base_url=base_url)
+
+def run_inria(workers):
+    max_inria_images = int(os.getenv("MAX_INRIA_IMAGES", 100))
+    download_data = os.getenv("DOWNLOAD_INRIA_DATA", "1") == "1"
+    extract_data = os.getenv("EXTRACT_INRIA_DATA", "1") == "1"
+    stream_extract = os.getenv("INRIA_STREAM_EXTRACT", "0") == "1"
+    include_gt = os.getenv("INRIA_INCLUDE_GT", "0") == "1"
+    chip_size = int(os.getenv("INRIA_CHIP_SIZE", 0)) or None
+    chip_overlap = int(os.getenv("INRIA_CHIP_OVERLAP", 0))
+    # INRIA_CHIP_WORKERS is the name used before COG conversion shared the pool
+    process_workers = int(os.getenv("INRIA_PROCESS_WORKERS") or os.getenv("INRIA_CHIP_WORKERS") or 0) or None
+    cog = os.getenv("INRIA_COG", "0") == "1"
+    materialize_mode = os.getenv("DATASET_MATERIALIZE", "copy")
+
+    return download_inria_images(cities=INRIA_CITIES, max_images=max_inria_images, output_dir="output/images/inria", download_data=download_data, extract_data=extract_data, stream_extract=stream_extract, include_gt=include_gt, max_workers=workers, chip_size=chip_size, chip_overlap=chip_overlap, process_workers=process_workers, cog=cog, materialize_mode=materialize_mode)
+
+def run_irf(workers):
+    max_irf_images = int(os.getenv("MAX_IRF_IMAGES", 100))
+    download_data = os.getenv("DOWNLOAD_IRF_DATA", "1") == "1"
+    extract_data = os.getenv("EXTRACT_IRF_DATA", "1") == "1"
+    materialize_mode = os.getenv("DATASET_MATERIALIZE", "copy")
+    export_annotations = os.getenv("IRF_EXPORT_ANNOTATIONS", "0") == "1"
+    process_workers = int(os.getenv("IRF_PROCESS_WORKERS", 0)) or None
+
+    return download_irf_images(max_irf_images, output_dir="output/images/irf", download_data=download_data, extract_data=extract_data, materialize_mode=materialize_mode, max_workers=workers, export_annotations_data=export_annotations, process_workers=process_workers)
+
+def run_nasa(workers):
+    max_nasa_images = int(os.getenv("MAX_NASA_IMAGES", 100))
+
+    convert_to = os.getenv("IMAGE_CONVERT_TO") or None
+
+    return download_nasa_images(max_images=max_nasa_images, output_dir="output/images/nasa", convert_to=convert_to, max_workers=workers)
+
+def target_max_side():
+    # Longest side requested from the Wikimedia thumbnailer, 0 keeps originals
+    return int(os.getenv("TARGET_MAX_SIDE", 0)) or None
+
+def run_wikimedia(workers):
+    max_wikimedia_images_per_category = int(os.getenv("MAX_WIKIMEDIA_IMAGES", 50))
+    crawl_depth = int(os.getenv("WIKIMEDIA_CRAWL_DEPTH", 0))
+    max_subcategories = int(os.getenv("WIKIMEDIA_MAX_SUBCATEGORIES", 50))
+
+    return download_wikimedia_images(categories=WIKIMEDIA_CATEGORIES, max_images_per_category=max_wikimedia_images_per_category, output_dir="output/images/wikimedia", max_workers=workers, target_max_side=target_max_side(), crawl_depth=crawl_depth, max_subcategories=max_subcategories)
+
+def run_wikipedia_images(workers):
+    input_wiki_json = Path("output/wiki.jsonl")
+    download_workers = int(os.getenv("WIKIPEDIA_DOWNLOAD_WORKERS", workers))
+    queue_size = int(os.getenv("WIKIPEDIA_QUEUE_SIZE", 100))
+    discovery = os.getenv("WIKIPEDIA_DISCOVERY", "html")
+    convert_to = os.getenv("IMAGE_CONVERT_TO") or None
+
+    return download_wikipedia_images(input_file=input_wiki_json, output_dir="output/images/wikipedia", max_workers=workers, download_workers=download_workers, queue_size=queue_size, discovery=discovery, convert_to=convert_to, target_max_side=target_max_side())
+
+# Source name -> (toggle env variable, runner)
+SOURCES = {
+    "Copernicus": ("RUN_COPERNICUS", run_copernicus),
+    "EPREL": ("RUN_EPREL", run_eprel),
+    "INRIA": ("RUN_INRIA", run_inria),
+    "IRF": ("RUN_IRF", run_irf),
+    "NASA": ("RUN_NASA", run_nasa),
+    "Wikimedia": ("RUN_WIKIMEDIA", run_wikimedia),
+    "Wikipedia_images": ("RUN_WIKIPEDIA_IMAGES", run_wikipedia_images),
+}
+
+def run_source(source_name, runner, workers):
+    logging.info(f"Starting {source_name} retrieval with {workers} worker(s).")
+    start = time.perf_counter()
+    try:
+        items = runner(workers) or 0
+        status = "ok"
+        logging.info(f"{source_name} retrieval completed successfully.")
+    except Exception as e:
+        items = 0
+        status = "failed"
+        logging.error(f"{source_name} retrieval failed: {e}")
+    return {"source": source_name, "status": status, "items": items, "seconds": time.perf_counter() - start}
+
+def log_summary(results):
+    lines = [f"{'Source':<18} {'Status':<8} {'Items':>8} {'Time (s)':>10}"]
+    for result in results:
+        lines.append(f"{result['source']:<18} {result['status']:<8} {result['items']:>8} {result['seconds']:>10.1f}")
+    logging.info("Run summary:\n" + "\n".join(lines))
+
+def run_dedupe():
+    radius = int(os.getenv("DEDUPE_RADIUS", 6))
+    action = os.getenv("DEDUPE_ACTION", "flag")
+    workers = int(os.getenv("DEDUPE_WORKERS", 4))
+
+    return dedupe_images(root="output/images", index_path="output/phash_index.json", radius=radius, action=action, report_path="output/near_duplicates.json", max_workers=workers)
+
+def run_pack_shards():
+    shards_dir = os.getenv("SHARDS_DIR", "output/shards")
+    max_shard_bytes = int(os.getenv("SHARD_MAX_MB", 1024)) * 1024 * 1024
+    max_shard_samples = int(os.getenv("SHARD_MAX_SAMPLES", 0)) or None
+    seed = int(os.getenv("SHARD_SEED", 0))
+    workers = int(os.getenv("SHARD_WORKERS", 4))
+
+    return pack_shards(root="output/images", shards_dir=shards_dir, max_shard_bytes=max_shard_bytes, max_shard_samples=max_shard_samples, seed=seed, max_workers=workers)
+
 def main():
     configure_logging()
     logging.info("=== Starting Image Retrieval ===")
 
     # Environment-driven toggles
-    RUN_COPERNICUS = os.getenv("RUN_COPERNICUS", "1") == "1"
-    RUN_EPREL = os.getenv("RUN_EPREL", "1") == "1"
-    RUN_INRIA = os.getenv("RUN_INRIA", "1") == "1"
-    RUN_IRF = os.getenv("RUN_IRF", "1") == "1"
-    RUN_NASA = os.getenv("RUN_NASA", "1") == "1"
-    RUN_WIKIMEDIA = os.getenv("RUN_WIKIMEDIA", "1") == "1"
-    RUN_WIKIPEDIA_IMAGES = os.getenv("RUN_WIKIPEDIA_IMAGES", "1") == "1"
-
-    logging.info(f"""
-        RUN_COPERNICUS: {RUN_COPERNICUS},
-        RUN_EPREL: {RUN_EPREL},
-        RUN_INRIA: {RUN_INRIA},
-        RUN_IRF: {RUN_IRF},
-        RUN_NASA: {RUN_NASA},
-        RUN_WIKIMEDIA: {RUN_WIKIMEDIA},
-        RUN_WIKIPEDIA_IMAGES: {RUN_WIKIPEDIA_IMAGES}
-    """)
+    enabled = {name: os.getenv(toggle, "1") == "1" for name, (toggle, _) in SOURCES.items()}
+
+    logging.info("\n".join(f"{SOURCES[name][0]}: {flag}" for name, flag in enabled.items()))
+
+    # Global cap on concurrently running sources
+    max_workers = int(os.getenv("MAX_WORKERS", len(SOURCES)))
 
     # Directories setup
     output_dir = Path("output/images")
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # --- Copernicus Satellite Images ---
-    if RUN_COPERNICUS:
-        try:
-            download_copernicus_images(output_dir="output/images/copernicus")
-            logging.info("Copernicus images retrieved successfully.")
-        except Exception as e:
-            logging.error(f"Copernicus retrieval failed: {e}")
-
-    # --- EPREL Energy Labels ---
-    if RUN_EPREL:
-        try:
-            download_eprel_labels(output_dir="output/images/eprel")
-            logging.info("EPREL labels retrieved successfully.")
-        except Exception as e:
-            logging.error(f"EPREL retrieval failed: {e}")
-
-    # --- INRIA Aerial Images ---
-    if RUN_INRIA:
-        try:
-            cities = ["Austin", "Chicago", "Kitsap", "Western Tyrol", "Vienna", "Bellingham", "Bloomington", "Innsbruck", "San Francisco", "Eastern Tyrol"]
-            max_inria_images = int(os.getenv("MAX_INRIA_IMAGES", 100))
-            download_data = os.getenv("DOWNLOAD_INRIA_DATA", "1") == "1"
-            extract_data = os.getenv("EXTRACT_INRIA_DATA", "1") == "1"
-
-            download_inria_images(cities=cities, max_images=max_inria_images, output_dir="output/images/inria", download_data=download_data, extract_data=extract_data)
-            logging.info("INRIA images retrieved successfully.")
-        except Exception as e:
-            logging.error(f"INRIA retrieval failed: {e}")
-
-    # --- IRF Facade Images ---
-    if RUN_IRF:
-        try:
-            max_irf_images = int(os.getenv("MAX_IRF_IMAGES", 100))
-            download_data=os.getenv("DOWNLOAD_IRF_DATA", "1") == "1"
-            extract_data=os.getenv("EXTRACT_IRF_DATA", "1") == "1"
-            
-            download_irf_images(max_irf_images, output_dir="output/images/irf", download_data=download_data, extract_data=extract_data)
-            
-            logging.info("IRF images retrieved successfully.")
-        except Exception as e:
-            logging.error(f"IRF retrieval failed: {e}")
-
-    # --- NASA Earth Observatory Images ---
-    if RUN_NASA:
-        try:
-            max_nasa_images = int(os.getenv("MAX_NASA_IMAGES", 100))
-            
-            download_nasa_images(max_images=max_nasa_images, output_dir="output/images/nasa")
-            
-            logging.info("NASA images retrieved successfully.")
-        except Exception as e:
-            logging.error(f"NASA retrieval failed: {e}")
-
-    # --- Wikimedia Commons Images ---
-    if RUN_WIKIMEDIA:
-        try:
-            wikimedia_categories = [
-                "Satellite pictures", 
-                "Construction", 
-                "Power plants",
-                "Solar panels", 
-                "Wind turbines",
-                "Smart meters",
-                "Electric vehicles",
-                "Energy storage",
-                "Energy efficiency labels",
-                "Renewable energy",
-                "Energy transition",
-                "Energy infrastructure",
-                "Nuclear power plants",
-                "Hydroelectric power plants",
-                "Geothermal energy",   
-                "Biomass energy",
-                "Coal-fired power plants",
-                "Geothermal power plants",
-                "Biofuels",
-                "Power transmission lines",
-                "Smart grids",
-                "Substations",
-                "Control rooms of transmission systems",
-                "Energy monitoring systems",
-                "Energy management systems",
-                "Natural gas power plants",
-                "Zero energy buildings",
-                "Energy-efficient buildings",
-                "Near-zero energy buildings",
-                "Energy-efficient appliances",
-                "Energy-efficient lighting",
-                "Energy-efficient HVAC systems",
-                "Energy-efficient windows",
-                "smart home energy systems",
-                "microgrids",
-                "demand response systems",
-                "virtual power plants",
-                "carbon capture and storage",
-                "fuel cells",
-                "hydrogen energy systems",
-                "green roofs",
-                "solar thermal systems",
-                "energy-efficient transportation",
-                "energy-efficient industrial processes",
-                "energy-efficient manufacturing",
-                "district heating systems",
-                "district cooling systems",
-                "heat pumps",
-                "photovoltaic systems",
-            ]
-
-            max_wikimedia_images_per_category = int(os.getenv("MAX_WIKIMEDIA_IMAGES", 50))
-            
-            download_wikimedia_images(categories=wikimedia_categories, max_images_per_category=max_wikimedia_images_per_category, output_dir="output/images/wikimedia")
-            
-            logging.info("Wikimedia images retrieved successfully.")
-        except Exception as e:
-            logging.error(f"Wikimedia retrieval failed: {e}")
-
-    # --- Wikipedia Article Images ---
-    if RUN_WIKIPEDIA_IMAGES:
-        try:
-            input_wiki_json = Path("output/wiki.jsonl")
-            
-            download_wikipedia_images(input_file=input_wiki_json, output_dir="output/images/wikipedia")
-
-            logging.info("Wikipedia images retrieved successfully.")
-        except Exception as e:
-            logging.error(f"Wikipedia images retrieval failed: {e}")
+    # Conditional-GET cache shared by all sources
+    if os.getenv("HTTP_CACHE", "0") == "1":
+        cache_dir = os.getenv("HTTP_CACHE_DIR", "output/http_cache")
+        cache_max_bytes = int(os.getenv("HTTP_CACHE_MAX_MB", 2048)) * 1024 * 1024
+        http_cache.configure(cache_dir, cache_max_bytes)
+
+    # Resumable runs: finished items are skipped, failed ones retried with backoff
+    if os.getenv("JOB_LEDGER", "0") == "1":
+        job_ledger.configure(os.getenv("JOB_LEDGER_PATH", "output/jobs.sqlite"))
+
+    # Consolidated metadata catalog, optionally replacing the per-image JSON sidecars
+    if os.getenv("CATALOG", "0") == "1":
+        sidecars = os.getenv("CATALOG_SIDECARS", "1") == "1"
+        catalog.configure(os.getenv("CATALOG_PATH", "output/catalog.sqlite"), root=str(output_dir), sidecars=sidecars)
+
+    jobs = [(name, SOURCES[name][1], source_workers(name, max_workers)) for name, flag in enabled.items() if flag]
+
+    results = []
+    if jobs:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as executor:
+            futures = [executor.submit(run_source, *job) for job in jobs]
+            results = [future.result() for future in futures]
+
+    http_client.close_sessions()
+    job_ledger.close()
+
+    # --- Post-processing: near-duplicates across all sources ---
+    if os.getenv("RUN_DEDUPE", "0") == "1":
+        results.append(run_source("Dedupe", lambda workers: run_dedupe(), 1))
+
+    # --- Post-processing: WebDataset tar shards for training ---
+    if os.getenv("RUN_PACK_SHARDS", "0") == "1":
+        results.append(run_source("Shards", lambda workers: run_pack_shards(), 1))
+
+    catalog_export = os.getenv("CATALOG_EXPORT_JSONL")
+    if catalog.is_enabled() and catalog_export:
+        catalog.export_jsonl(catalog_export)
+    catalog.close()
 
+    log_summary(results)
     logging.info("=== Image Retrieval Completed ===")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,248 @@
+"""Consolidated metadata catalog for all sources.
+
+Run from the repository root to fill the catalog from an existing output tree
+or export it:
+
+    python -m scripts.catalog rebuild [--root output/images] [--db output/catalog.sqlite] [--workers N]
+    python -m scripts.catalog export catalog.jsonl [--db output/catalog.sqlite]
+"""
+import os
+import re
+import sys
+import json
+import sqlite3
+import logging
+import argparse
+import threading
+from scripts.process_pool import process_pool
+
+# Records are buffered and inserted in one transaction per batch
+BATCH_SIZE = 500
+
+RESOLUTION_PATTERN = re.compile(r"(\d+)\s*x\s*(\d+)")
+
+# Images a sidecar can belong to, as in phash_index
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+
+_connection = None
+_root = None
+_sidecars = True
+_pending = []
+_lock = threading.Lock()
+
+def _connect(db_path):
+    connection = sqlite3.connect(db_path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            title TEXT,
+            width INTEGER,
+            height INTEGER,
+            retrieved_date TEXT,
+            metadata TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS image_categories (
+            path TEXT NOT NULL,
+            category TEXT NOT NULL,
+            PRIMARY KEY (path, category)
+        );
+        CREATE INDEX IF NOT EXISTS idx_images_source ON images (source);
+        CREATE INDEX IF NOT EXISTS idx_images_resolution ON images (width, height);
+        CREATE INDEX IF NOT EXISTS idx_images_date ON images (retrieved_date);
+        CREATE INDEX IF NOT EXISTS idx_image_categories_category ON image_categories (category);
+    """)
+    return connection
+
+def configure(db_path, root="output/images", sidecars=True):
+    """Open (or create) the catalog at db_path for metadata written under root.
+
+    With sidecars False, metadata goes to the catalog only and no per-image
+    JSON files are written.
+    """
+    global _connection, _root, _sidecars
+    connection = _connect(db_path)
+    with _lock:
+        _connection = connection
+        _root = root
+        _sidecars = sidecars
+    logging.info(f"Metadata catalog enabled at {db_path} (sidecars {'on' if sidecars else 'off'}).")
+
+def is_enabled():
+    return _connection is not None
+
+def parse_resolution(metadata):
+    """(width, height) from the "WxH" resolution or image size a source recorded."""
+    info = metadata.get("additional_info", {})
+    for key in ("resolution", "image_size"):
+        match = RESOLUTION_PATTERN.search(str(info.get(key, "")))
+        if match:
+            return int(match.group(1)), int(match.group(2))
+    return None, None
+
+def make_record(rel_path, metadata):
+    width, height = parse_resolution(metadata)
+    return (
+        rel_path.replace(os.sep, "/"),
+        rel_path.replace(os.sep, "/").split("/")[0],
+        metadata.get("title") or metadata.get("filename"),
+        width,
+        height,
+        metadata.get("retrieved_date"),
+        json.dumps(metadata),
+        metadata.get("categories") or []
+    )
+
+def _insert(connection, records):
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO images (path, source, title, width, height, retrieved_date, metadata) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [record[:7] for record in records]
+        )
+        connection.executemany("DELETE FROM image_categories WHERE path = ?", [(record[0],) for record in records])
+        connection.executemany(
+            "INSERT OR IGNORE INTO image_categories (path, category) VALUES (?, ?)",
+            [(record[0], category) for record in records for category in record[7]]
+        )
+
+def _flush():
+    # Caller holds _lock
+    if _pending and _connection is not None:
+        _insert(_connection, _pending)
+        _pending.clear()
+
+def write_metadata(metadata_path, metadata):
+    """Write an image's metadata: the JSON sidecar (unless turned off) and the catalog record."""
+    if _sidecars or _connection is None:
+        with open(metadata_path, 'w', encoding='utf-8') as json_file:
+            json.dump(metadata, json_file, indent=4)
+    if _connection is None:
+        return
+    with _lock:
+        _pending.append(make_record(os.path.relpath(metadata_path, _root), metadata))
+        if len(_pending) >= BATCH_SIZE:
+            _flush()
+
+def read_metadata(metadata_path):
+    """Metadata of an image from its sidecar, or from the catalog. None if unknown."""
+    try:
+        with open(metadata_path, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        pass
+    if _connection is None:
+        return None
+    rel_path = os.path.relpath(metadata_path, _root).replace(os.sep, "/")
+    with _lock:
+        _flush()
+        row = _connection.execute("SELECT metadata FROM images WHERE path = ?", (rel_path,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def iter_metadata(directory):
+    """(metadata path, metadata) of every catalog record under directory."""
+    if _connection is None:
+        return
+    prefix = os.path.relpath(directory, _root).replace(os.sep, "/").rstrip("/") + "/"
+    with _lock:
+        _flush()
+        rows = _connection.execute(
+            "SELECT path, metadata FROM images WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+        ).fetchall()
+    for rel_path, metadata in rows:
+        yield os.path.join(_root, rel_path), json.loads(metadata)
+
+def remove_metadata(metadata_path):
+    """Delete an image's sidecar and catalog record."""
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+    if _connection is None:
+        return
+    rel_path = os.path.relpath(metadata_path, _root).replace(os.sep, "/")
+    with _lock:
+        _flush()
+        with _connection:
+            _connection.execute("DELETE FROM images WHERE path = ?", (rel_path,))
+            _connection.execute("DELETE FROM image_categories WHERE path = ?", (rel_path,))
+
+def export_jsonl(jsonl_path, connection=None):
+    """Write every catalog record as one JSON line: the metadata plus its path and source."""
+    connection = connection or _connection
+    with _lock:
+        _flush()
+        rows = connection.execute("SELECT path, source, metadata FROM images ORDER BY path").fetchall()
+    with open(jsonl_path, 'w', encoding='utf-8') as jsonl_file:
+        for rel_path, source, metadata in rows:
+            jsonl_file.write(json.dumps({"path": rel_path, "source": source, **json.loads(metadata)}) + "\n")
+    logging.info(f"Exported {len(rows)} catalog records to {jsonl_path}.")
+    return len(rows)
+
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _flush()
+            _connection.close()
+            _connection = None
+
+def iter_sidecars(root):
+    """Metadata sidecars under root: JSON files next to an image with the same name."""
+    for dirpath, _, files in os.walk(root):
+        stems = {os.path.splitext(file)[0] for file in files if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS}
+        for file in sorted(files):
+            stem, ext = os.path.splitext(file)
+            if ext == ".json" and stem in stems:
+                yield os.path.join(dirpath, file)
+
+def _read_records(paths, root):
+    records = []
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as json_file:
+                records.append(make_record(os.path.relpath(path, root), json.load(json_file)))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Skipping unreadable metadata {path}: {e}")
+    return records
+
+def rebuild(root="output/images", db_path="output/catalog.sqlite", max_workers=None):
+    """Fill the catalog from the sidecars of an existing output tree, parsing them in parallel."""
+    paths = list(iter_sidecars(root))
+    logging.info(f"Rebuilding catalog {db_path} from {len(paths)} sidecars under {root}...")
+    connection = _connect(db_path)
+    chunks = [paths[start:start + BATCH_SIZE] for start in range(0, len(paths), BATCH_SIZE)]
+
+    written = 0
+    with process_pool(max_workers) as executor:
+        for records in executor.map(_read_records, chunks, [root] * len(chunks)):
+            _insert(connection, records)
+            written += len(records)
+    connection.close()
+
+    logging.info(f"Catalog rebuild complete: {written} records.")
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild or export the metadata catalog.")
+    parser.add_argument("--db", default="output/catalog.sqlite", help="Catalog database path")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_parser = commands.add_parser("rebuild", help="Fill the catalog from existing sidecars")
+    rebuild_parser.add_argument("--root", default="output/images", help="Output tree to scan")
+    rebuild_parser.add_argument("--workers", type=int, default=None, help="Parsing processes (default: one per core)")
+
+    export_parser = commands.add_parser("export", help="Export the catalog as JSONL")
+    export_parser.add_argument("jsonl_path", help="JSONL file to write")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "rebuild":
+        rebuild(args.root, args.db, args.workers)
+    else:
+        connection = _connect(args.db)
+        export_jsonl(args.jsonl_path, connection)
+        connection.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
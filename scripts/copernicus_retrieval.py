@@ -1,19 +1,29 @@
 import requests
+import aiohttp
+import asyncio
 import os
-import json
+import math
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from scripts import catalog, http_client, job_ledger
 
 # Base URL for ArcGIS ImageServer
 BASE_URL = "https://image.discomap.eea.europa.eu/arcgis/rest/services/GioLand/VHR_2021_LAEA/ImageServer/exportImage"
 
+# Largest width/height the ImageServer renders in a single exportImage call
+MAX_EXPORT_SIZE = 4000
+
+LEDGER_SOURCE = "copernicus"
+LEDGER_SOURCE_TILED = "copernicus_tiled"
+
 output_dir = "copernicus_images"
 os.makedirs(output_dir, exist_ok=True)
 
-headers = {
-    "User-Agent": "mAiEnergyBot/1.0 (kosmylo@gmail.com; downloading Copernicus satellite images for research)"
-}
-
 # Define EU regions with bounding boxes (LAEA projection)
 regions = [
   {
@@ -450,10 +460,9 @@ regions = [
   }
 ]
 
-def download_copernicus_image(country_name, region_name, bbox, output_dir):
+def build_export_params(bbox):
     x_min, y_min, x_max, y_max = bbox
-
-    params = {
+    return {
         "bbox": f"{x_min},{y_min},{x_max},{y_max}",
         "bboxSR": "3035",
         "imageSR": "3035",
@@ -462,14 +471,52 @@ def download_copernicus_image(country_name, region_name, bbox, output_dir):
         "f": "image"
     }
 
+def region_file_path(country_name, region_name, output_dir, extension):
     region_dir = os.path.join(output_dir, country_name)
     os.makedirs(region_dir, exist_ok=True)
+    return os.path.join(region_dir, f"{region_name.replace(' ', '_')}.{extension}")
+
+def save_copernicus_metadata(country_name, region_name, bbox, url, output_dir, resolution="1200x1200", image_format="jpg", ground_resolution_m=None):
+    x_min, y_min, x_max, y_max = bbox
 
-    image_file_name = f"{region_name.replace(' ', '_')}.jpg"
-    image_file_path = os.path.join(region_dir, image_file_name)
+    metadata = {
+        "title": f"Copernicus VHR 2021 - {region_name}",
+        "url": url,
+        "document_type": "copernicus_satellite_image",
+        "categories": ["satellite_imagery", "land_use", "solar_wind_potential"],
+        "source": {
+            "provider": "Copernicus Land Monitoring Service",
+            "repository": "land.copernicus.eu"
+        },
+        "retrieved_date": datetime.today().strftime('%Y-%m-%d'),
+        "additional_info": {
+            "resolution": resolution,
+            "format": image_format,
+            "bbox": {
+                "x_min": x_min,
+                "y_min": y_min,
+                "x_max": x_max,
+                "y_max": y_max
+            },
+            "projection": "EPSG:3035",
+            "country": country_name,
+            "region": region_name
+        }
+    }
+
+    if ground_resolution_m:
+        metadata["additional_info"]["ground_resolution_m"] = ground_resolution_m
+
+    metadata_path = region_file_path(country_name, region_name, output_dir, "json")
+
+    catalog.write_metadata(metadata_path, metadata)
+
+def download_copernicus_image(country_name, region_name, bbox, output_dir):
+    params = build_export_params(bbox)
+    image_file_path = region_file_path(country_name, region_name, output_dir, "jpg")
 
     try:
-        response = requests.get(BASE_URL, headers=headers, params=params, stream=True)
+        response = http_client.get(BASE_URL, params=params, stream=True)
         response.raise_for_status()
         
         with open(image_file_path, 'wb') as file:
@@ -477,55 +524,239 @@ def download_copernicus_image(country_name, region_name, bbox, output_dir):
                 file.write(chunk)
         logging.info(f"Downloaded image: {region_name} ({country_name})")
 
-        metadata = {
-            "title": f"Copernicus VHR 2021 - {region_name}",
-            "url": response.url,
-            "document_type": "copernicus_satellite_image",
-            "categories": ["satellite_imagery", "land_use", "solar_wind_potential"],
-            "source": {
-                "provider": "Copernicus Land Monitoring Service",
-                "repository": "land.copernicus.eu"
-            },
-            "retrieved_date": datetime.today().strftime('%Y-%m-%d'),
-            "additional_info": {
-                "resolution": "1200x1200",
-                "format": "jpg",
-                "bbox": {
-                    "x_min": x_min,
-                    "y_min": y_min,
-                    "x_max": x_max,
-                    "y_max": y_max
-                },
-                "projection": "EPSG:3035",
-                "country": country_name,
-                "region": region_name
-            }
-        }
+        save_copernicus_metadata(country_name, region_name, bbox, response.url, output_dir)
 
-        metadata_file_name = f"{region_name.replace(' ', '_')}.json"
-        metadata_path = os.path.join(region_dir, metadata_file_name)
-
-        with open(metadata_path, 'w') as json_file:
-            json.dump(metadata, json_file, indent=4)
+        job_ledger.mark_done(LEDGER_SOURCE, region_job_id(country_name, region_name))
+        return True
 
     except requests.HTTPError as http_err:
+        job_ledger.mark_failed(LEDGER_SOURCE, region_job_id(country_name, region_name), http_err)
         logging.error(f"HTTP error for {region_name} ({country_name}): {http_err}")
     except Exception as err:
+        job_ledger.mark_failed(LEDGER_SOURCE, region_job_id(country_name, region_name), err)
         logging.error(f"Unexpected error for {region_name} ({country_name}): {err}")
 
-def download_copernicus_images(output_dir="output/images/copernicus"):
-    logging.info("Starting Copernicus satellite image downloads.")
-    
+    return False
+
+def plan_tiles(bbox, resolution_m, max_tile_size=MAX_EXPORT_SIZE):
+    """Split a bbox into a grid of exportImage requests at a fixed metres-per-pixel.
+
+    Returns the mosaic size in pixels, its snapped bbox and a list of
+    (window, tile_bbox) pairs, where the window locates the tile in the mosaic.
+    """
+    x_min, y_min, x_max, y_max = bbox
+    width = math.ceil((x_max - x_min) / resolution_m)
+    height = math.ceil((y_max - y_min) / resolution_m)
+
+    tiles = []
+    for row_off in range(0, height, max_tile_size):
+        tile_height = min(max_tile_size, height - row_off)
+        for col_off in range(0, width, max_tile_size):
+            tile_width = min(max_tile_size, width - col_off)
+            tile_bbox = (
+                x_min + col_off * resolution_m,
+                y_max - (row_off + tile_height) * resolution_m,
+                x_min + (col_off + tile_width) * resolution_m,
+                y_max - row_off * resolution_m
+            )
+            tiles.append((Window(col_off, row_off, tile_width, tile_height), tile_bbox))
+
+    mosaic_bbox = (x_min, y_max - height * resolution_m, x_min + width * resolution_m, y_max)
+    return width, height, mosaic_bbox, tiles
+
+def fetch_tile(tile_bbox, tile_width, tile_height):
+    params = build_export_params(tile_bbox)
+    params["size"] = f"{tile_width},{tile_height}"
+    params["format"] = "tiff"
+
+    response = http_client.get(BASE_URL, params=params)
+    response.raise_for_status()
+
+    with MemoryFile(response.content) as memfile, memfile.open() as src:
+        return src.read()
+
+def download_copernicus_tiled_image(country_name, region_name, bbox, output_dir, resolution_m, max_workers=1, max_tile_size=MAX_EXPORT_SIZE):
+    width, height, mosaic_bbox, tiles = plan_tiles(bbox, resolution_m, max_tile_size)
+    image_file_path = region_file_path(country_name, region_name, output_dir, "tif")
+    # The mosaic is only moved into place once every tile is written
+    tmp_path = image_file_path + ".part"
+    logging.info(f"Exporting {region_name} ({country_name}) at {resolution_m} m/px: {width}x{height} px in {len(tiles)} tiles")
+
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "crs": "EPSG:3035",
+        "transform": from_origin(mosaic_bbox[0], mosaic_bbox[3], resolution_m, resolution_m),
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER"
+    }
+
+    try:
+        dst = None
+        pending = {}
+        remaining = iter(tiles)
+        # Bounded number of tiles in flight, so only a few tiles sit in memory at once
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                for window, tile_bbox in remaining:
+                    future = executor.submit(fetch_tile, tile_bbox, int(window.width), int(window.height))
+                    pending[future] = window
+                    if len(pending) >= 2 * max_workers:
+                        break
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window = pending.pop(future)
+                    data = future.result()
+                    if dst is None:
+                        dst = rasterio.open(tmp_path, 'w', count=data.shape[0], dtype=data.dtype, **profile)
+                    dst.write(data, window=window)
+        dst.close()
+        os.replace(tmp_path, image_file_path)
+    except Exception as err:
+        if dst is not None:
+            dst.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        job_ledger.mark_failed(LEDGER_SOURCE_TILED, region_job_id(country_name, region_name), err)
+        logging.error(f"Tiled export failed for {region_name} ({country_name}): {err}")
+        return False
+
+    logging.info(f"Downloaded tiled image: {region_name} ({country_name})")
+    save_copernicus_metadata(country_name, region_name, mosaic_bbox, BASE_URL, output_dir, resolution=f"{width}x{height}", image_format="tif", ground_resolution_m=resolution_m)
+    job_ledger.mark_done(LEDGER_SOURCE_TILED, region_job_id(country_name, region_name))
+    return True
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying, honouring Retry-After when given in seconds."""
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return int(retry_after)
+    return http_client.RETRY_BACKOFF_FACTOR * (2 ** attempt)
+
+async def fetch_copernicus_image(session, country_name, region_name, bbox, output_dir):
+    params = build_export_params(bbox)
+    image_file_path = region_file_path(country_name, region_name, output_dir, "jpg")
+    # The image is only moved into place once it has fully arrived
+    tmp_path = image_file_path + ".part"
+
+    try:
+        for attempt in range(http_client.RETRY_TOTAL + 1):
+            try:
+                async with session.get(BASE_URL, params=params) as response:
+                    if response.status in http_client.RETRY_STATUSES and attempt < http_client.RETRY_TOTAL:
+                        delay = retry_delay(response, attempt)
+                        logging.warning(f"HTTP {response.status} for {region_name} ({country_name}), retrying in {delay}s")
+                        await asyncio.sleep(delay)
+                        continue
+                    response.raise_for_status()
+
+                    # Stream the rendered image to disk as it arrives
+                    with open(tmp_path, 'wb') as file:
+                        async for chunk in response.content.iter_chunked(8192):
+                            file.write(chunk)
+                    url = str(response.url)
+            except aiohttp.ClientResponseError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                if attempt == http_client.RETRY_TOTAL:
+                    raise
+                delay = http_client.RETRY_BACKOFF_FACTOR * (2 ** attempt)
+                logging.warning(f"{type(err).__name__} for {region_name} ({country_name}), retrying in {delay}s: {err}")
+                await asyncio.sleep(delay)
+                continue
+            os.replace(tmp_path, image_file_path)
+            break
+
+        logging.info(f"Downloaded image: {region_name} ({country_name})")
+        save_copernicus_metadata(country_name, region_name, bbox, url, output_dir)
+        job_ledger.mark_done(LEDGER_SOURCE, region_job_id(country_name, region_name))
+        return True
+
+    except aiohttp.ClientResponseError as http_err:
+        job_ledger.mark_failed(LEDGER_SOURCE, region_job_id(country_name, region_name), http_err)
+        logging.error(f"HTTP error for {region_name} ({country_name}): {http_err}")
+    except Exception as err:
+        job_ledger.mark_failed(LEDGER_SOURCE, region_job_id(country_name, region_name), err)
+        logging.error(f"Unexpected error for {region_name} ({country_name}): {err}")
+
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return False
+
+async def download_copernicus_images_async(output_dir, max_concurrency, per_host_limit):
+    connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=per_host_limit)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=http_client.DEFAULT_TIMEOUT, sock_read=http_client.DEFAULT_TIMEOUT)
+    headers = {"User-Agent": http_client.USER_AGENT}
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        results = await asyncio.gather(*[
+            fetch_copernicus_image(session, country_name, region_name, bbox, output_dir)
+            for country_name, region_name, bbox in pending_regions(LEDGER_SOURCE)
+        ])
+
+    return sum(results)
+
+def iter_regions():
+    """Yield (country, region, bbox) for every region to download."""
     for country in regions:
         country_name = country["name"]
         subregions = country.get("subregions", [])
 
         if not subregions:
-            download_copernicus_image(country_name, country_name, country["bbox"], output_dir)
+            yield country_name, country_name, country["bbox"]
         else:
             for subregion in subregions:
-                region_name = subregion["name"]
-                bbox = subregion["bbox"]
-                download_copernicus_image(country_name, region_name, bbox, output_dir)
-    
-    logging.info("Copernicus satellite image download complete.")
\ No newline at end of file
+                yield country_name, subregion["name"], subregion["bbox"]
+
+def region_job_id(country_name, region_name):
+    return f"{country_name}/{region_name}"
+
+def pending_regions(ledger_source):
+    """Yield the regions the job ledger has not finished yet."""
+    for country_name, region_name, bbox in iter_regions():
+        job_id = region_job_id(country_name, region_name)
+        if job_ledger.should_run(ledger_source, job_id):
+            job_ledger.mark_pending(ledger_source, job_id)
+            yield country_name, region_name, bbox
+
+def download_copernicus_images(output_dir="output/images/copernicus", max_workers=1, async_mode=False, max_concurrency=16, per_host_limit=8, resolution_m=None, max_tile_size=MAX_EXPORT_SIZE):
+    logging.info("Starting Copernicus satellite image downloads.")
+
+    if resolution_m:
+        if max_tile_size < 1:
+            raise ValueError(f"Copernicus tile size must be at least 1 px, got {max_tile_size}")
+        if max_tile_size > MAX_EXPORT_SIZE:
+            logging.warning(f"Copernicus tile size {max_tile_size} exceeds the ImageServer limit, using {MAX_EXPORT_SIZE}.")
+            max_tile_size = MAX_EXPORT_SIZE
+        if async_mode:
+            logging.warning("Copernicus async mode does not apply to tiled exports, fetching tiles on threads.")
+        # Regions one after another, tiles of each region in parallel
+        downloaded = sum(
+            download_copernicus_tiled_image(country_name, region_name, bbox, output_dir, resolution_m, max_workers, max_tile_size)
+            for country_name, region_name, bbox in pending_regions(LEDGER_SOURCE_TILED)
+        )
+        logging.info(f"Copernicus tiled image download complete: {downloaded} images.")
+        return downloaded
+
+    if async_mode:
+        logging.info(f"Using async downloads: {max_concurrency} requests in flight, {per_host_limit} per host.")
+        downloaded = asyncio.run(download_copernicus_images_async(output_dir, max_concurrency, per_host_limit))
+        logging.info(f"Copernicus satellite image download complete: {downloaded} images.")
+        return downloaded
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_copernicus_image, country_name, region_name, bbox, output_dir)
+            for country_name, region_name, bbox in pending_regions(LEDGER_SOURCE)
+        ]
+        downloaded = sum(future.result() for future in futures)
+
+    logging.info(f"Copernicus satellite image download complete: {downloaded} images.")
+    return downloaded
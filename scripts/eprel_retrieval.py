@@ -1,13 +1,34 @@
 import os
 import re
-import json
 import logging
+import threading
 from datetime import datetime
-import requests
-from pdf2image import convert_from_path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from pdf2image import convert_from_bytes
+from PIL import Image
+from scripts import catalog, http_client, job_ledger
+from scripts.process_pool import process_pool
 
 BASE_URL = "https://eprel.ec.europa.eu/labels"
 
+# Public product listing, paged per product group: <LISTING_URL>/<group>?_page=N&_limit=M
+LISTING_URL = "https://eprel.ec.europa.eu/api/products"
+LISTING_PAGE_SIZE = 100
+
+# Label file suffixes: Label_<id>.pdf and Label_<id>_big_color.pdf
+LABEL_VARIANTS = ("", "_big_color")
+
+LEDGER_SOURCE = "eprel"
+
+# Label renderings, in DPI. The first one is the main label image
+DEFAULT_DPIS = (200,)
+
+PDF_MAGIC = b"%PDF"
+
+# Category -> label variant that last worked, tried first for the next product
+_label_variants = {}
+_label_variants_lock = threading.Lock()
+
 # Product list: (category, ID, name)
 products = [
     # Light sources
@@ -122,9 +143,6 @@ products = [
     ("residentialventilationunits", 2085254, "Zehnder ComfoAir Q600 Ventilation Unit"),
     ("residentialventilationunits", 2082335, "Zehnder ComfoAir Q350 Ventilation Unit"),
 
-    # Hot water storage tanks for water heaters
-    ("waterheaters", 108766, "Ariston Blu1 Eco Electric Water Heater"),
-
     # Hot water storage tanks for water heaters
     ("hotwaterstoragetanks", 27672, "Wolf Pufferspeicher SPU-1-200 Tank"),
     ("hotwaterstoragetanks", 27673, "Wolf Pufferspeicher SPU-2-500 Tank"),
@@ -157,75 +175,74 @@ products = [
     ("tyres", 501593, "Bridgestone Turanza T005 (225/45R17 94Y)")
 ]
 
-headers = {
-    "User-Agent": "mAiEnergyBot/1.0 (kosmylo@gmail.com; downloading EPREL labels for research)"
-}
-
 def sanitize_filename(filename):
     """Sanitize filename by replacing problematic characters."""
     return re.sub(r'[\\/*?:"<>|()+\[\]{}]', '_', filename)
 
-def download_eprel_labels(output_dir):
-
-    os.makedirs(output_dir, exist_ok=True)
-
-    for category, product_id, product_name in products:
-        try:
-            download_eprel_label(category, product_id, product_name, output_dir)
-        except Exception as e:
-            logging.error(f"Error downloading/processing {product_name} ({product_id}): {e}")
-
-    logging.info("EPREL energy label download and conversion complete.")
-
-def download_eprel_label(category, product_id, product_name, base_output_dir):
-    urls_to_try = [
-        f"{BASE_URL}/{category}/Label_{product_id}.pdf",
-        f"{BASE_URL}/{category}/Label_{product_id}_big_color.pdf"
-    ]
-
+def render_label(pdf_bytes, dpis, image_base_path):
+    """Rasterise page 1 of a label PDF once, at the highest DPI, and save every size.
+
+    Runs in a worker process. The first DPI in dpis is saved as
+    <image_base_path>.png, the others as <image_base_path>_<dpi>dpi.png,
+    downscaled from the single high-DPI render. Returns (dpi, path, width, height)
+    for each saved image.
+    """
+    max_dpi = max(dpis)
+    page = convert_from_bytes(pdf_bytes, dpi=max_dpi, first_page=1, last_page=1)[0]
+
+    renders = []
+    for index, dpi in enumerate(dpis):
+        image = page
+        if dpi != max_dpi:
+            scale = dpi / max_dpi
+            image = page.resize((max(1, round(page.width * scale)), max(1, round(page.height * scale))), Image.LANCZOS)
+        image_path = f"{image_base_path}.png" if index == 0 else f"{image_base_path}_{dpi}dpi.png"
+        image.save(image_path, 'PNG')
+        renders.append((dpi, image_path, image.width, image.height))
+    return renders
+
+def label_urls(category, product_id, base_url=BASE_URL, skip_variants=()):
+    """(variant, url) pairs for a label, the variant known to work for the category first."""
+    with _label_variants_lock:
+        preferred = _label_variants.get(category)
+    variants = sorted((variant for variant in LABEL_VARIANTS if variant not in skip_variants), key=lambda variant: variant != preferred)
+    return [(variant, f"{base_url}/{category}/Label_{product_id}{variant}.pdf") for variant in variants]
+
+def fetch_eprel_label(category, product_id, product_name, base_output_dir, base_url=BASE_URL, skip_variants=()):
+    """Download a label PDF, trying each URL variant not in skip_variants.
+
+    Returns (variant, url, pdf_bytes) or None.
+    """
     category_dir = os.path.join(base_output_dir, category)
     os.makedirs(category_dir, exist_ok=True)
 
-    safe_product_name = sanitize_filename(product_name)
-    
-    pdf_file_name = f"{safe_product_name}_{product_id}.pdf"
+    pdf_file_name = f"{sanitize_filename(product_name)}_{product_id}.pdf"
     pdf_file_path = os.path.join(category_dir, pdf_file_name)
 
-    for url in urls_to_try:
+    for variant, url in label_urls(category, product_id, base_url, skip_variants):
         try:
-            response = requests.get(url, headers=headers, stream=True)
+            response = http_client.get(url)
             if response.status_code != 200:
                 logging.warning(f"Failed to download from {url}: HTTP {response.status_code}")
                 continue
 
-            with open(pdf_file_path, 'wb') as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
-
-            try:
-                images = convert_from_path(pdf_file_path, dpi=200)
-                break  # PDF and conversion successful
-            except Exception as e:
+            pdf_bytes = response.content
+            if not pdf_bytes.startswith(PDF_MAGIC):
                 logging.warning(f"Invalid PDF for {product_name} ({product_id}), retrying other URL...")
-                os.remove(pdf_file_path)
                 continue
+
+            with open(pdf_file_path, 'wb') as file:
+                file.write(pdf_bytes)
+            return variant, url, pdf_bytes
         except Exception as e:
             logging.error(f"Request failed for {url}: {e}")
             continue
-    else:
-        logging.error(f"Failed to download/convert PDF for {product_name} ({product_id}) after retries.")
-        return
 
-    image_file_name = f"{safe_product_name}_{product_id}.png"
-    image_file_path = os.path.join(category_dir, image_file_name)
-
-    try:
-        images[0].save(image_file_path, 'PNG')
-        logging.info(f"Saved label image: {image_file_name}")
-    except Exception as e:
-        logging.error(f"Failed to convert/save image for {product_name} ({product_id}): {e}")
-        return
+    logging.error(f"Failed to download PDF for {product_name} ({product_id}) after retries.")
+    return None
 
+def save_label_metadata(category, product_id, product_name, url, renders, base_output_dir):
+    _, _, width, height = renders[0]
     metadata = {
         "title": product_name,
         "url": url,
@@ -237,14 +254,177 @@ def download_eprel_label(category, product_id, product_name, base_output_dir):
         },
         "retrieved_date": datetime.today().strftime('%Y-%m-%d'),
         "additional_info": {
-            "resolution": f"{images[0].width}x{images[0].height}",
+            "resolution": f"{width}x{height}",
             "format": "png"
         }
     }
+    if len(renders) > 1:
+        metadata["additional_info"]["renditions"] = [
+            {"dpi": dpi, "file": os.path.basename(path), "resolution": f"{w}x{h}"}
+            for dpi, path, w, h in renders
+        ]
+
+    metadata_file_name = f"{sanitize_filename(product_name)}_{product_id}.json"
+    metadata_path = os.path.join(base_output_dir, category, metadata_file_name)
+
+    catalog.write_metadata(metadata_path, metadata)
+    logging.info(f"Saved metadata for: {product_name}")
+
+def iter_listed_products(category, listing_url=LISTING_URL, filters=None, max_products=None, api_key=None, page_size=LISTING_PAGE_SIZE):
+    """Page through the EPREL product listing of one product group, yielding (category, ID, name)."""
+    headers = {"x-api-key": api_key} if api_key else None
+    listed = 0
+    page = 1
+    while True:
+        params = {"_page": page, "_limit": page_size, **(filters or {})}
+        try:
+            response = http_client.get(f"{listing_url}/{category}", params=params, headers=headers)
+            response.raise_for_status()
+            hits = response.json().get("hits", [])
+        except Exception as e:
+            logging.error(f"EPREL listing failed for {category} (page {page}): {e}")
+            return
+
+        for hit in hits:
+            product_id = hit.get("eprelRegistrationNumber")
+            if product_id is None:
+                continue
+            product_name = " ".join(str(hit[key]) for key in ("supplierOrTrademark", "modelIdentifier") if hit.get(key))
+            yield category, int(product_id), product_name or f"{category} {product_id}"
+            listed += 1
+            if max_products and listed >= max_products:
+                return
+
+        if len(hits) < page_size:
+            return
+        page += 1
+
+def iter_products(discover=False, categories=None, listing_url=LISTING_URL, listing_filters=None, max_products=None, api_key=None):
+    """The curated products, then every listed product when discovering, each once."""
+    seen = set()
+
+    def unique(product_iter):
+        for category, product_id, product_name in product_iter:
+            if (category, product_id) not in seen:
+                seen.add((category, product_id))
+                yield category, product_id, product_name
+
+    yield from unique(products)
+    if not discover:
+        return
+
+    categories = categories or list(dict.fromkeys(category for category, _, _ in products))
+    for category in categories:
+        logging.info(f"Discovering EPREL products in {category}.")
+        yield from unique(iter_listed_products(category, listing_url, listing_filters, max_products, api_key))
+
+def submit_render(download, product, tried, render_pool, dpis, output_dir):
+    """Hand a finished download to the render pool.
+
+    Returns (render future, url, variant, variants tried so far) or None.
+    """
+    category, product_id, product_name = product
+    job_id = f"{category}/{product_id}"
+    try:
+        result = download.result()
+    except Exception as e:
+        job_ledger.mark_failed(LEDGER_SOURCE, job_id, e)
+        logging.error(f"Error downloading {product_name} ({product_id}): {e}")
+        return None
+    if result is None:
+        job_ledger.mark_failed(LEDGER_SOURCE, job_id, "No valid label PDF")
+        return None
+
+    variant, url, pdf_bytes = result
+    image_base_path = os.path.join(output_dir, category, f"{sanitize_filename(product_name)}_{product_id}")
+    return render_pool.submit(render_label, pdf_bytes, dpis, image_base_path), url, variant, tried | {variant}
+
+def finish_render(render, product, url, variant, tried, output_dir):
+    """Save the metadata of a rendered label.
+
+    Returns True when done, False on failure, or None when the PDF did not
+    render and another label variant is left to try.
+    """
+    category, product_id, product_name = product
+    job_id = f"{category}/{product_id}"
+    try:
+        label_renders = render.result()
+    except Exception as e:
+        if len(tried) < len(LABEL_VARIANTS):
+            logging.warning(f"Invalid PDF for {product_name} ({product_id}) ({e}), retrying other URL...")
+            return None
+        job_ledger.mark_failed(LEDGER_SOURCE, job_id, e)
+        logging.error(f"Failed to convert/save image for {product_name} ({product_id}): {e}")
+        return False
+    try:
+        logging.info(f"Saved label image: {os.path.basename(label_renders[0][1])}")
+        save_label_metadata(category, product_id, product_name, url, label_renders, output_dir)
+    except Exception as e:
+        job_ledger.mark_failed(LEDGER_SOURCE, job_id, e)
+        logging.error(f"Failed to convert/save image for {product_name} ({product_id}): {e}")
+        return False
+    with _label_variants_lock:
+        _label_variants[category] = variant
+    job_ledger.mark_done(LEDGER_SOURCE, job_id)
+    return True
+
+def download_eprel_labels(output_dir, max_workers=1, dpis=DEFAULT_DPIS, render_workers=None, discover=False, categories=None, listing_url=LISTING_URL, listing_filters=None, max_products=None, api_key=None, queue_size=100, base_url=BASE_URL):
+    """Download label PDFs on a thread pool and rasterise them on a process pool.
+
+    Downloads are I/O bound and rendering is CPU bound, so each finished
+    download is handed straight to a render process sized to the host's cores.
+    Products stream in from the curated list and, when discover is set, from
+    the EPREL listing; at most queue_size downloads and renders are in flight.
+    A PDF that fails to render is replaced by the next label variant.
+    """
+    if queue_size < 1:
+        raise ValueError(f"EPREL queue size must be at least 1, got {queue_size}")
+    os.makedirs(output_dir, exist_ok=True)
+    dpis = list(dpis)
+    downloaded = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as download_pool, process_pool(render_workers) as render_pool:
+        downloads = {}
+        renders = {}
+
+        def drain(return_when):
+            nonlocal downloaded
+            done, _ = wait(downloads, return_when=return_when)
+            for future in done:
+                product, tried = downloads.pop(future)
+                submitted = submit_render(future, product, tried, render_pool, dpis, output_dir)
+                if submitted:
+                    render, url, variant, tried = submitted
+                    renders[render] = (product, url, variant, tried)
+            if len(renders) >= queue_size or return_when == ALL_COMPLETED:
+                done, _ = wait(renders, return_when=return_when)
+                for render in done:
+                    product, url, variant, tried = renders.pop(render)
+                    finished = finish_render(render, product, url, variant, tried, output_dir)
+                    if finished is None:
+                        submit_download(product, tried)
+                    else:
+                        downloaded += finished
+
+        def submit_download(product, tried=frozenset()):
+            category, product_id, product_name = product
+            future = download_pool.submit(fetch_eprel_label, category, product_id, product_name, output_dir, base_url, tried)
+            downloads[future] = (product, tried)
+
+        for product in iter_products(discover, categories, listing_url, listing_filters, max_products, api_key):
+            category, product_id, product_name = product
+            job_id = f"{category}/{product_id}"
+            if not job_ledger.should_run(LEDGER_SOURCE, job_id):
+                downloaded += job_ledger.get_status(LEDGER_SOURCE, job_id) == job_ledger.DONE
+                continue
+            job_ledger.mark_pending(LEDGER_SOURCE, job_id)
+
+            while len(downloads) >= queue_size:
+                drain(FIRST_COMPLETED)
+            submit_download(product)
 
-    metadata_file_name = f"{safe_product_name}_{product_id}.json"
-    metadata_path = os.path.join(category_dir, metadata_file_name)
+        while downloads or renders:
+            drain(ALL_COMPLETED)
 
-    with open(metadata_path, 'w') as json_file:
-        json.dump(metadata, json_file, indent=4)
-    logging.info(f"Saved metadata for: {product_name}")
\ No newline at end of file
+    logging.info(f"EPREL energy label download and conversion complete: {downloaded} labels.")
+    return downloaded
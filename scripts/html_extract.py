@@ -0,0 +1,117 @@
+"""Targeted HTML extraction for the NASA and Wikipedia scrapers.
+
+Pages are parsed with lxml's C parser and queried with precompiled XPath
+expressions that only visit the elements each scraper needs. Text follows
+BeautifulSoup's get_text: comments, script and style contents are skipped.
+"""
+import re
+import codecs
+import lxml.html
+from lxml import etree
+
+# Without a known encoding libxml2 decodes pages as Latin-1
+CONTENT_TYPE_CHARSET = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+META_SNIFF_BYTES = 1024
+
+TEXT_NODES = etree.XPath(".//text()[not(ancestor::script) and not(ancestor::style)]")
+
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+NASA_TITLE = etree.XPath("(//h1)[1]")
+NASA_PUBLISHED = etree.XPath("//p[contains(., 'Published')]")
+NASA_TOPIC_LINKS = etree.XPath("//a[contains(@href, '/topic/')]")
+NASA_LINKS = etree.XPath("//a")
+NASA_CAPTION_IMG = etree.XPath("(//img[@alt])[1]")
+
+WIKIPEDIA_FIGURES = etree.XPath(
+    f"//*[{_has_class('mw-parser-output')}]//*[self::figure or (self::div and {_has_class('thumb')})]"
+)
+FIRST_IMG = etree.XPath("(.//img)[1]")
+FIRST_FIGCAPTION = etree.XPath("(.//figcaption)[1]")
+FIRST_THUMBCAPTION = etree.XPath(f"(.//div[{_has_class('thumbcaption')}])[1]")
+
+def _known_encoding(name):
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def page_encoding(content, content_type=None):
+    """Encoding of an HTML page: the Content-Type charset, else its <meta> charset, else UTF-8."""
+    match = CONTENT_TYPE_CHARSET.search(content_type or "")
+    if match and _known_encoding(match.group(1)):
+        return _known_encoding(match.group(1))
+    match = META_CHARSET.search(content[:META_SNIFF_BYTES])
+    if match and _known_encoding(match.group(1).decode("ascii")):
+        return _known_encoding(match.group(1).decode("ascii"))
+    return "utf-8"
+
+def parse(content, content_type=None):
+    """Parse an HTML page (bytes or str) into an lxml tree.
+
+    Bytes are decoded with page_encoding, given the response's Content-Type header.
+    """
+    if isinstance(content, str):
+        return lxml.html.fromstring(content)
+    parser = lxml.html.HTMLParser(encoding=page_encoding(content, content_type))
+    return lxml.html.fromstring(content, parser=parser)
+
+def get_text(element, separator="", strip=False):
+    """Text of an element and its descendants, like BeautifulSoup's get_text."""
+    strings = TEXT_NODES(element)
+    if strip:
+        strings = [string.strip() for string in strings if string.strip()]
+    return separator.join(strings)
+
+def tag_string(element):
+    """The element's only string, following single-child chains, like BeautifulSoup's .string."""
+    while True:
+        children = list(element)
+        if not children:
+            return element.text
+        if len(children) > 1 or element.text or children[0].tail:
+            return None
+        element = children[0]
+
+def fragment_text(html, separator=" "):
+    """Stripped text of an HTML fragment such as a Commons image description."""
+    if not html:
+        return ""
+    return get_text(lxml.html.fragment_fromstring(html, create_parent="div"), separator, strip=True)
+
+def nasa_article(content, content_type=None):
+    """Fields the NASA scraper reads from an Earth Observatory article page.
+
+    Returns a dict with the title, the "Published" paragraph text (without
+    the word, or None), the topic link texts, the first JPEG/PNG link and the
+    first image alt text.
+    """
+    root = parse(content, content_type)
+
+    title_tags = NASA_TITLE(root)
+    published_tags = NASA_PUBLISHED(root)
+    image_link = next((link for link in NASA_LINKS(root) if tag_string(link) in ("JPEG", "PNG")), None)
+    caption_tags = NASA_CAPTION_IMG(root)
+
+    return {
+        "title": get_text(title_tags[0], strip=True) if title_tags else "untitled",
+        "published": get_text(published_tags[0]).replace("Published", "").strip() if published_tags else None,
+        "topics": [get_text(link).strip().lower() for link in NASA_TOPIC_LINKS(root)],
+        "image_url": image_link.get("href") if image_link is not None else None,
+        "caption": caption_tags[0].get("alt") if caption_tags else ""
+    }
+
+def wikipedia_figures(content, content_type=None):
+    """(img attributes, caption) of every figure or thumb in a Wikipedia article body."""
+    root = parse(content, content_type)
+    figures = []
+    for figure in WIKIPEDIA_FIGURES(root):
+        img_tags = FIRST_IMG(figure)
+        if not img_tags:
+            continue
+        caption_tags = FIRST_FIGCAPTION(figure) or FIRST_THUMBCAPTION(figure)
+        caption = get_text(caption_tags[0], strip=True) if caption_tags else ""
+        figures.append((dict(img_tags[0].attrib), caption))
+    return figures
@@ -0,0 +1,213 @@
+import os
+import json
+import uuid
+import hashlib
+import tempfile
+import threading
+import logging
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Responses larger than this are streamed through and never cached
+MAX_ENTRY_BYTES = 256 * 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+# Response headers kept alongside the cached body
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+_cache_dir = None
+_max_bytes = 0
+_total_bytes = 0
+_lock = threading.Lock()
+
+def configure(cache_dir, max_bytes):
+    """Enable the on-disk cache in cache_dir, capped at max_bytes."""
+    global _cache_dir, _max_bytes, _total_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+    # Bodies left half-written by an interrupted run
+    for name in os.listdir(cache_dir):
+        if name.endswith(".tmp"):
+            os.remove(os.path.join(cache_dir, name))
+    with _lock:
+        _cache_dir = cache_dir
+        _max_bytes = max_bytes
+        _total_bytes = sum(size for _, _, size in _entries())
+    logging.info(f"HTTP cache enabled in {cache_dir} ({_total_bytes} of {max_bytes} bytes used).")
+
+def is_enabled():
+    return _cache_dir is not None
+
+def _key(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+def _meta_path(key):
+    return os.path.join(_cache_dir, f"{key}.json")
+
+def _entries():
+    """Yield (meta_path, body_path, size) for every cached body.
+
+    Bodies are named <key>.<version>.body and the metadata of a key names
+    the version it currently serves.
+    """
+    for name in os.listdir(_cache_dir):
+        if not name.endswith(".body"):
+            continue
+        body_path = os.path.join(_cache_dir, name)
+        try:
+            yield _meta_path(name.split(".")[0]), body_path, os.path.getsize(body_path)
+        except OSError:
+            continue
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+def lookup(url):
+    """Return the cached entry for url, or None."""
+    entry = _read_meta(_meta_path(_key(url)))
+    if not entry or not os.path.exists(os.path.join(_cache_dir, entry.get("body", ""))):
+        return None
+    return entry
+
+def validators(entry):
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def _file_response(body_file, url, request, headers):
+    """A 200 response whose body streams from an open file."""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.request = request
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.raw = body_file
+    return response
+
+def cached_response(entry, not_modified):
+    """Build a 200 response from the cached body of a 304 Not Modified reply.
+
+    Returns None when the body is gone (evicted or replaced since the
+    lookup), which the caller treats as a cache miss.
+    """
+    body_path = os.path.join(_cache_dir, entry["body"])
+    try:
+        body_file = open(body_path, 'rb')
+    except OSError:
+        return None
+    # Touch the entry so eviction is least-recently-used
+    try:
+        os.utime(body_path)
+    except OSError:
+        pass
+
+    response = _file_response(body_file, entry["url"], not_modified.request, entry.get("headers", {}))
+    response.from_cache = True
+    return response
+
+def store(url, response):
+    """Cache a 200 response that carries an ETag or Last-Modified validator.
+
+    The body is streamed to a temporary file in the cache, which is renamed
+    into place before the metadata pointing at it is published, so readers
+    never see a partial body. Returns the response to hand to the caller:
+    the original one when nothing was cached, otherwise one that streams the
+    body from disk.
+    """
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return response
+
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_ENTRY_BYTES:
+        return response
+
+    key = _key(url)
+    fd, tmp_path = tempfile.mkstemp(dir=_cache_dir, prefix=f"{key}.", suffix=".tmp")
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                tmp_file.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    finally:
+        response.close()
+
+    # Served headers describe the decoded body now on disk
+    headers = {name: value for name, value in response.headers.items() if name.lower() not in ("content-encoding", "content-length")}
+
+    if size > MAX_ENTRY_BYTES:
+        # Too large to keep: serve it from the unlinked temporary file
+        body_file = open(tmp_path, 'rb')
+        os.remove(tmp_path)
+        return _file_response(body_file, url, response.request, headers)
+
+    version = uuid.uuid4().hex
+    body_name = f"{key}.{version}.body"
+    body_path = os.path.join(_cache_dir, body_name)
+    entry = {
+        "url": url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "body": body_name,
+        "headers": {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+    }
+
+    global _total_bytes
+    meta_path = _meta_path(key)
+    with _lock:
+        os.replace(tmp_path, body_path)
+        previous = _read_meta(meta_path)
+        tmp_meta_path = f"{meta_path}.{version}.tmp"
+        with open(tmp_meta_path, 'w', encoding='utf-8') as meta_file:
+            json.dump(entry, meta_file)
+        os.replace(tmp_meta_path, meta_path)
+        _total_bytes += size
+
+        # The previous version's body is no longer referenced
+        if previous and previous.get("body") and previous["body"] != body_name:
+            previous_path = os.path.join(_cache_dir, previous["body"])
+            try:
+                _total_bytes -= os.path.getsize(previous_path)
+                os.remove(previous_path)
+            except OSError:
+                pass
+        body_file = open(body_path, 'rb')
+        if _total_bytes > _max_bytes:
+            _evict()
+
+    return _file_response(body_file, url, response.request, headers)
+
+def _evict():
+    """Drop least recently used entries until the cache fits its size cap."""
+    global _total_bytes
+    entries = sorted(_entries(), key=lambda item: os.path.getmtime(item[1]))
+    for meta_path, body_path, size in entries:
+        if _total_bytes <= _max_bytes:
+            break
+        # Unpublish first, so a concurrent lookup never finds metadata without a body
+        entry = _read_meta(meta_path)
+        if entry and entry.get("body") == os.path.basename(body_path):
+            try:
+                os.remove(meta_path)
+            except OSError:
+                pass
+        try:
+            os.remove(body_path)
+        except OSError:
+            continue
+        _total_bytes -= size
+    logging.debug(f"HTTP cache evicted down to {_total_bytes} bytes.")
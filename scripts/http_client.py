@@ -0,0 +1,85 @@
+import threading
+import logging
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from scripts import http_cache
+
+# Single User-Agent for every source, compliant with Wikimedia/Wikipedia policy
+USER_AGENT = "mAiEnergyBot/1.0 (kosmylo@gmail.com; downloading images for research project)"
+
+# Retry policy for transient failures
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 1.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Connection pool per host
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+DEFAULT_TIMEOUT = 60
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def create_session():
+    retry = Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["GET", "HEAD"],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT})
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session(url):
+    """Return the pooled session for the host of the given URL."""
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = create_session()
+            _sessions[host] = session
+            logging.debug(f"Created HTTP session for {host}")
+    return session
+
+def get(url, params=None, **kwargs):
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    session = get_session(url)
+
+    if not http_cache.is_enabled():
+        return session.get(url, params=params, **kwargs)
+
+    # Conditional GET against the on-disk cache
+    full_url = requests.Request("GET", url, params=params).prepare().url
+    request_headers = dict(kwargs.pop("headers", None) or {})
+    entry = http_cache.lookup(full_url)
+    headers = {**request_headers, **http_cache.validators(entry)} if entry else request_headers
+
+    response = session.get(full_url, headers=headers, **kwargs)
+
+    if response.status_code == 304 and entry:
+        response.close()
+        cached = http_cache.cached_response(entry, response)
+        if cached is not None:
+            logging.debug(f"Not modified, served from cache: {full_url}")
+            return cached
+        # The body was evicted after the lookup: fetch it again unconditionally
+        response = session.get(full_url, headers=request_headers, **kwargs)
+    if response.status_code == 200:
+        return http_cache.store(full_url, response)
+    return response
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
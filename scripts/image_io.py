@@ -0,0 +1,71 @@
+import os
+from PIL import Image, ImageFile
+
+# Allow truncated images
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# File extension written for each conversion target
+CONVERT_EXTENSIONS = {
+    "JPEG": ".jpg",
+    "PNG": ".png",
+    "WEBP": ".webp",
+    "TIFF": ".tif"
+}
+
+def stream_to_file(response, path, chunk_size=8192):
+    """Write a response body to disk as it arrives, byte for byte."""
+    with open(path, 'wb') as file:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            file.write(chunk)
+
+def probe_image(path):
+    """Return (width, height, format) read from the file header only.
+
+    PIL parses the header on open and decodes pixels lazily, so nothing
+    is decoded as long as the image data is never accessed.
+    """
+    with Image.open(path) as img:
+        return img.width, img.height, img.format
+
+def convert_image(path, convert_to, new_path=None):
+    """Decode the image at path and re-encode it as convert_to, returning the new path.
+
+    The new file goes next to path with the target's extension unless
+    new_path is given. The source file is removed.
+    """
+    convert_to = convert_to.upper()
+    new_path = new_path or os.path.splitext(path)[0] + CONVERT_EXTENSIONS.get(convert_to, f".{convert_to.lower()}")
+
+    with Image.open(path) as img:
+        if convert_to == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(new_path, convert_to)
+
+    if new_path != path:
+        os.remove(path)
+    return new_path
+
+def save_image(response, path, convert_to=None):
+    """Stream an image response to path and describe it.
+
+    The original bytes are kept unless convert_to (a PIL format name such as
+    "PNG") is given. The image is written to a .part file and only renamed
+    into place once it opens, so a failed download never leaves a partial
+    file behind. Returns (path, width, height, format) of the saved file.
+    """
+    download_path = path + ".part"
+    if convert_to:
+        path = os.path.splitext(path)[0] + CONVERT_EXTENSIONS.get(convert_to.upper(), f".{convert_to.lower()}")
+    part_path = path + ".part"
+    try:
+        stream_to_file(response, download_path)
+        if convert_to:
+            convert_image(download_path, convert_to, part_path)
+        width, height, image_format = probe_image(part_path)
+        os.replace(part_path, path)
+    except BaseException:
+        for leftover in {download_path, part_path}:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    return path, width, height, image_format
@@ -1,11 +1,16 @@
 import os
-import json
 import zipfile
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from kaggle.api.kaggle_api_extended import KaggleApi
 import rasterio
-from rasterio.warp import transform_bounds
+from rasterio.shutil import copy as copy_raster
+from rasterio.warp import transform, transform_bounds
+from rasterio.windows import Window
 from tqdm import tqdm
+from scripts import catalog, materialize
+from scripts.process_pool import process_pool
 from datetime import datetime
 import logging
 
@@ -13,6 +18,10 @@ import logging
 DATASET_NAME = "sagar100rathod/inria-aerial-image-labeling-dataset"
 DOWNLOAD_PATH = "./inria_dataset"
 EXTRACTED_PATH = "./inria_dataset_extracted"
+# Image folders inside the archive, in selection order
+ZIP_IMAGE_DIRS = ["AerialImageDataset/train/images/", "AerialImageDataset/test/images/"]
+COPY_BUFFER_SIZE = 1024 * 1024
+COG_BLOCK_SIZE = 512
 COUNTRY_MAPPING = {
     "austin": "USA",
     "chicago": "USA",
@@ -46,7 +55,7 @@ def extract_dataset(zip_path, extract_to):
     else:
         logging.error("Zip file not found. Extraction failed.")
 
-def select_images(cities, max_images_total, extracted_path, output_dir):
+def select_images(cities, max_images_total, extracted_path, output_dir, materialize_mode="copy", max_workers=1):
     logging.info("Selecting images based on specified cities...")
     image_dirs = [
         os.path.join(extracted_path, "AerialImageDataset/train/images"),
@@ -61,7 +70,7 @@ def select_images(cities, max_images_total, extracted_path, output_dir):
             logging.warning(f"Directory not found: {dir_path}")
             continue
         for fname in os.listdir(dir_path):
-            city_key = fname.split('.')[0].rstrip('0123456789')
+            city_key = city_from_filename(fname)
             if city_key in city_keys:
                 selected_images.append((os.path.join(dir_path, fname), city_key))
     
@@ -69,25 +78,144 @@ def select_images(cities, max_images_total, extracted_path, output_dir):
         selected_images = selected_images[:max_images_total]
 
     os.makedirs(output_dir, exist_ok=True)
-    for img_path, _ in tqdm(selected_images, desc="Copying images"):
-        shutil.copy(img_path, output_dir)
+    materialize.materialize_files([(img_path, output_dir) for img_path, _ in selected_images], materialize_mode, max_workers)
 
-    logging.info(f"Selected and copied {len(selected_images)} images.")
+    logging.info(f"Selected and materialised {len(selected_images)} images.")
     return selected_images
 
-def generate_metadata(selected_images, output_dir):
+def city_from_filename(fname):
+    return fname.split('.')[0].rstrip('0123456789')
+
+def select_zip_members(zip_path, cities, max_images_total, include_gt=False):
+    """Pick image members (and their ground-truth masks) from the archive's central directory."""
+    city_keys = [city.lower() for city in cities]
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        names = zip_ref.namelist()
+    name_set = set(names)
+
+    selected = []
+    for image_dir in ZIP_IMAGE_DIRS:
+        for name in names:
+            if not name.startswith(image_dir) or name.endswith('/'):
+                continue
+            fname = name[len(image_dir):]
+            city_key = city_from_filename(fname)
+            if '/' in fname or city_key not in city_keys:
+                continue
+            gt_name = name.replace("/images/", "/gt/") if include_gt else None
+            selected.append((name, gt_name if gt_name in name_set else None, city_key))
+
+    if max_images_total:
+        selected = selected[:max_images_total]
+    return selected
+
+def stream_members(zip_path, members, max_workers=1):
+    """Copy (member, destination) pairs out of the archive in parallel, one handle per thread."""
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def copy_member(member, destination):
+        zip_ref = getattr(local, "zip_ref", None)
+        if zip_ref is None:
+            zip_ref = local.zip_ref = zipfile.ZipFile(zip_path, 'r')
+            with handles_lock:
+                handles.append(zip_ref)
+        with zip_ref.open(member) as src, open(destination, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(copy_member, member, destination) for member, destination in members]
+            for future in tqdm(futures, desc="Streaming images"):
+                future.result()
+    finally:
+        for zip_ref in handles:
+            zip_ref.close()
+
+def select_images_from_zip(zip_path, cities, max_images_total, output_dir, include_gt=False, max_workers=1):
+    """Stream the selected images straight from the archive into output_dir, without extracting it.
+
+    Ground-truth masks, when requested, go to output_dir/gt under the same name.
+    """
+    logging.info(f"Selecting images from {zip_path} based on specified cities...")
+    if not os.path.exists(zip_path):
+        logging.error("Zip file not found. Selection failed.")
+        return []
+
+    selected = select_zip_members(zip_path, cities, max_images_total, include_gt)
+
+    os.makedirs(output_dir, exist_ok=True)
+    gt_dir = os.path.join(output_dir, "gt")
+    if include_gt:
+        os.makedirs(gt_dir, exist_ok=True)
+
+    members = []
+    selected_images = []
+    for name, gt_name, city_key in selected:
+        image_path = os.path.join(output_dir, os.path.basename(name))
+        members.append((name, image_path))
+        if gt_name:
+            members.append((gt_name, os.path.join(gt_dir, os.path.basename(gt_name))))
+        selected_images.append((image_path, city_key))
+
+    stream_members(zip_path, members, max_workers)
+
+    logging.info(f"Selected and streamed {len(selected_images)} images.")
+    return selected_images
+
+def read_raster_info(img_path):
+    with rasterio.open(img_path) as src:
+        return {
+            "bounds": tuple(src.bounds),
+            "crs": src.crs,
+            "res": src.res,
+            "width": src.width,
+            "height": src.height
+        }
+
+def latlon_bounds(infos, densify_pts=21):
+    """Lat/lon bounds of many rasters, with one batched transform per distinct CRS.
+
+    Like transform_bounds, each edge is densified so curved edges are enclosed.
+    """
+    by_crs = {}
+    for index, info in enumerate(infos):
+        by_crs.setdefault(info["crs"].to_string(), []).append(index)
+
+    results = [None] * len(infos)
+    steps = [i / (densify_pts - 1) for i in range(densify_pts)]
+    for indices in by_crs.values():
+        xs, ys = [], []
+        for index in indices:
+            left, bottom, right, top = infos[index]["bounds"]
+            for step in steps:
+                x = left + (right - left) * step
+                y = bottom + (top - bottom) * step
+                xs += [x, x, left, right]
+                ys += [bottom, top, y, y]
+        lons, lats = transform(infos[indices[0]]["crs"], 'EPSG:4326', xs, ys)
+
+        points = 4 * densify_pts
+        for position, index in enumerate(indices):
+            index_lons = lons[position * points:(position + 1) * points]
+            index_lats = lats[position * points:(position + 1) * points]
+            results[index] = (min(index_lons), min(index_lats), max(index_lons), max(index_lats))
+    return results
+
+def generate_metadata(selected_images, output_dir, max_workers=1):
     logging.info("Generating metadata for selected images...")
-    for img_path, city_key in tqdm(selected_images, desc="Generating metadata"):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        infos = list(tqdm(executor.map(read_raster_info, [img_path for img_path, _ in selected_images]), total=len(selected_images), desc="Reading image headers"))
+    all_bounds_latlon = latlon_bounds(infos)
+
+    for (img_path, city_key), info, bounds_latlon in zip(selected_images, infos, all_bounds_latlon):
         fname = os.path.basename(img_path)
         metadata_filename = os.path.splitext(fname)[0] + ".json"
         metadata_path = os.path.join(output_dir, metadata_filename)
 
-        with rasterio.open(img_path) as src:
-            bounds = src.bounds
-            crs = src.crs
-            res_x, res_y = src.res
-            width, height = src.width, src.height
-            bounds_latlon = transform_bounds(crs, 'EPSG:4326', *bounds)
+        left, bottom, right, top = info["bounds"]
+        res_x, res_y = info["res"]
 
         metadata = {
             "filename": fname,
@@ -96,13 +224,13 @@ def generate_metadata(selected_images, output_dir):
             "retrieved_date": datetime.today().strftime('%Y-%m-%d'),
             "additional_info": {
                 "resolution": f"{res_x:.2f} m/pixel",
-                "image_size": f"{width}x{height} px",
-                "crs": str(crs),
+                "image_size": f"{info['width']}x{info['height']} px",
+                "crs": str(info["crs"]),
                 "bounds_original_crs": {
-                    "xmin": bounds.left,
-                    "ymin": bounds.bottom,
-                    "xmax": bounds.right,
-                    "ymax": bounds.top
+                    "xmin": left,
+                    "ymin": bottom,
+                    "xmax": right,
+                    "ymax": top
                 },
                 "bounds_latlon": {
                     "xmin": bounds_latlon[0],
@@ -117,12 +245,169 @@ def generate_metadata(selected_images, output_dir):
             }
         }
 
-        with open(metadata_path, 'w') as meta_file:
-            json.dump(metadata, meta_file, indent=4)
+        catalog.write_metadata(metadata_path, metadata)
 
     logging.info("Metadata generation completed.")
 
-def download_inria_images(cities, max_images, output_dir, download_data, extract_data):
+def convert_to_cog(image_path):
+    """Rewrite a GeoTIFF in place as a tiled, deflate-compressed COG with internal overviews."""
+    tmp_path = os.path.splitext(image_path)[0] + ".cog.tmp.tif"
+    copy_raster(
+        image_path,
+        tmp_path,
+        driver="COG",
+        compress="DEFLATE",
+        predictor=2,
+        blocksize=COG_BLOCK_SIZE,
+        overview_resampling="average"
+    )
+    os.replace(tmp_path, image_path)
+    return image_path
+
+def convert_images_to_cog(selected_images, output_dir, max_workers=None):
+    """Convert the selected images in output_dir to COGs, one image per process."""
+    logging.info(f"Converting {len(selected_images)} images to Cloud-Optimized GeoTIFF...")
+    image_paths = [os.path.join(output_dir, os.path.basename(img_path)) for img_path, _ in selected_images]
+
+    converted = 0
+    with process_pool(max_workers) as executor:
+        futures = {executor.submit(convert_to_cog, image_path): image_path for image_path in image_paths}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Converting to COG"):
+            try:
+                future.result()
+                converted += 1
+            except Exception as e:
+                logging.error(f"COG conversion failed for {futures[future]}: {e}")
+
+    logging.info(f"COG conversion completed: {converted} images.")
+    return converted
+
+def chip_offsets(size, chip_size, stride):
+    """Chip start offsets along one axis; the last chip is aligned to the edge."""
+    if size < chip_size:
+        return []
+    offsets = list(range(0, size - chip_size + 1, stride))
+    if offsets[-1] != size - chip_size:
+        offsets.append(size - chip_size)
+    return offsets
+
+def find_gt_path(img_path, output_dir):
+    """Ground-truth mask of a tile, streamed into output_dir/gt or next to the extracted images."""
+    fname = os.path.basename(img_path)
+    candidates = [
+        os.path.join(output_dir, "gt", fname),
+        os.path.join(os.path.dirname(os.path.dirname(img_path)), "gt", fname)
+    ]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def write_chip(src, window, chip_path):
+    profile = src.profile.copy()
+    profile.update(
+        driver="GTiff",
+        width=window.width,
+        height=window.height,
+        transform=src.window_transform(window),
+        tiled=False,
+        compress="deflate"
+    )
+    profile.pop("blockxsize", None)
+    profile.pop("blockysize", None)
+    with rasterio.open(chip_path, 'w', **profile) as dst:
+        dst.write(src.read(window=window))
+
+def chip_tile(img_path, city_key, chips_dir, chip_size, overlap=0, gt_path=None):
+    """Cut one tile into chip_size chips with windowed reads. Runs in a worker process.
+
+    Only one chip is held in memory at a time. Returns (metadata path, metadata)
+    for each chip, written by the parent so the catalog stays in one process.
+    """
+    fname = os.path.basename(img_path)
+    stem = os.path.splitext(fname)[0]
+    stride = chip_size - overlap
+    gt_dir = os.path.join(chips_dir, "gt")
+
+    chips = []
+    with rasterio.open(img_path) as src:
+        gt_src = rasterio.open(gt_path) if gt_path else None
+        try:
+            crs = src.crs
+            for row_off in chip_offsets(src.height, chip_size, stride):
+                for col_off in chip_offsets(src.width, chip_size, stride):
+                    window = Window(col_off, row_off, chip_size, chip_size)
+                    chip_name = f"{stem}_r{row_off}_c{col_off}.tif"
+                    write_chip(src, window, os.path.join(chips_dir, chip_name))
+                    if gt_src is not None:
+                        write_chip(gt_src, window, os.path.join(gt_dir, chip_name))
+
+                    left, bottom, right, top = src.window_bounds(window)
+                    bounds_latlon = transform_bounds(crs, 'EPSG:4326', left, bottom, right, top)
+                    metadata = {
+                        "filename": chip_name,
+                        "city": city_key.capitalize(),
+                        "country": COUNTRY_MAPPING.get(city_key, "Unknown"),
+                        "retrieved_date": datetime.today().strftime('%Y-%m-%d'),
+                        "additional_info": {
+                            "source_tile": fname,
+                            "window": {"col_off": col_off, "row_off": row_off, "width": chip_size, "height": chip_size},
+                            "resolution": f"{src.res[0]:.2f} m/pixel",
+                            "image_size": f"{chip_size}x{chip_size} px",
+                            "crs": str(crs),
+                            "bounds_original_crs": {"xmin": left, "ymin": bottom, "xmax": right, "ymax": top},
+                            "bounds_latlon": {
+                                "xmin": bounds_latlon[0],
+                                "ymin": bounds_latlon[1],
+                                "xmax": bounds_latlon[2],
+                                "ymax": bounds_latlon[3]
+                            },
+                            "has_gt_mask": gt_src is not None
+                        },
+                        "source": {
+                            "provider": "Inria",
+                            "repository": DATASET_NAME
+                        }
+                    }
+                    chips.append((os.path.join(chips_dir, f"{stem}_r{row_off}_c{col_off}.json"), metadata))
+        finally:
+            if gt_src is not None:
+                gt_src.close()
+    return chips
+
+def generate_chips(selected_images, output_dir, chip_size, overlap=0, include_gt=False, max_workers=None):
+    """Cut every selected tile into training chips under output_dir/chips, one tile per process."""
+    if overlap >= chip_size:
+        raise ValueError(f"Chip overlap ({overlap}) must be smaller than the chip size ({chip_size}).")
+    logging.info(f"Cutting {len(selected_images)} tiles into {chip_size}px chips (overlap {overlap}px)...")
+
+    chips_dir = os.path.join(output_dir, "chips")
+    os.makedirs(chips_dir, exist_ok=True)
+    if include_gt:
+        os.makedirs(os.path.join(chips_dir, "gt"), exist_ok=True)
+
+    chips = 0
+    with process_pool(max_workers) as executor:
+        futures = {}
+        for img_path, city_key in selected_images:
+            gt_path = find_gt_path(img_path, output_dir) if include_gt else None
+            if include_gt and gt_path is None:
+                logging.warning(f"No ground-truth mask for {os.path.basename(img_path)}, chipping image only.")
+            future = executor.submit(chip_tile, img_path, city_key, chips_dir, chip_size, overlap, gt_path)
+            futures[future] = img_path
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Cutting chips"):
+            try:
+                for metadata_path, metadata in future.result():
+                    catalog.write_metadata(metadata_path, metadata)
+                    chips += 1
+            except Exception as e:
+                logging.error(f"Failed to chip {futures[future]}: {e}")
+
+    logging.info(f"Chip generation completed: {chips} chips.")
+    return chips
+
+def download_inria_images(cities, max_images, output_dir, download_data, extract_data, stream_extract=False, include_gt=False, max_workers=1, chip_size=None, chip_overlap=0, process_workers=None, cog=False, materialize_mode="copy"):
 
     api = authenticate_kaggle()
 
@@ -131,8 +416,19 @@ def download_inria_images(cities, max_images, output_dir, download_data, extract
     
     zip_file = os.path.join(DOWNLOAD_PATH, DATASET_NAME.split('/')[-1] + ".zip")
 
-    if extract_data:
-        extract_dataset(zip_file, EXTRACTED_PATH)
+    if stream_extract:
+        selected_images = select_images_from_zip(zip_file, cities, max_images, output_dir, include_gt, max_workers)
+    else:
+        if extract_data:
+            extract_dataset(zip_file, EXTRACTED_PATH)
+        selected_images = select_images(cities, max_images, EXTRACTED_PATH, output_dir, materialize_mode, max_workers)
+
+    if cog:
+        convert_images_to_cog(selected_images, output_dir, process_workers)
+
+    generate_metadata(selected_images, output_dir, max_workers)
+
+    if chip_size:
+        generate_chips(selected_images, output_dir, chip_size, chip_overlap, include_gt, process_workers)
 
-    selected_images = select_images(cities, max_images, EXTRACTED_PATH, output_dir)
-    generate_metadata(selected_images, output_dir)
+    return len(selected_images)
@@ -1,10 +1,12 @@
 import os
 import json
 import zipfile
-import shutil
+import numpy as np
 from kaggle.api.kaggle_api_extended import KaggleApi
 from PIL import Image
 from tqdm import tqdm
+from scripts import catalog, materialize
+from scripts.process_pool import process_pool
 from datetime import datetime
 import logging
 
@@ -12,6 +14,7 @@ import logging
 DATASET_NAME = "liushuyuu/irregular-facades-irfs"
 DOWNLOAD_PATH = "./irfs_dataset"
 EXTRACTED_PATH = "./irfs_dataset_extracted"
+ANNOTATIONS_DIR = "annotations"
 
 def authenticate_kaggle():
     api = KaggleApi()
@@ -33,7 +36,7 @@ def extract_dataset(zip_path, extract_to):
     else:
         logging.error("Zip file not found. Extraction failed.")
 
-def collect_jpg_images_and_json(extracted_path, max_images_total, output_dir):
+def collect_jpg_images_and_json(extracted_path, max_images_total, output_dir, materialize_mode="copy", max_workers=1):
     logging.info("Selecting JPEG images and JSON annotations...")
     image_paths = []
     json_paths = {}
@@ -54,13 +57,109 @@ def collect_jpg_images_and_json(extracted_path, max_images_total, output_dir):
     image_paths = sorted(image_paths)[:max_images_total]
 
     os.makedirs(output_dir, exist_ok=True)
-    for img_path in tqdm(image_paths, desc="Copying images"):
-        shutil.copy(img_path, output_dir)
+    materialize.materialize_files([(img_path, output_dir) for img_path in image_paths], materialize_mode, max_workers)
 
-    logging.info(f"Copied {len(image_paths)} images.")
+    logging.info(f"Materialised {len(image_paths)} images.")
     return image_paths, json_paths
 
-def generate_metadata(image_paths, json_paths, output_dir):
+def probe_size(img_path):
+    """(width, height) read from the image header, or (None, None) if it cannot be opened."""
+    try:
+        with Image.open(img_path) as img:
+            return img.size
+    except Exception as e:
+        logging.warning(f"Failed to open image {os.path.basename(img_path)}: {e}")
+        return None, None
+
+def parse_annotation(img_path, json_path=None):
+    """Read one LabelMe annotation: (width, height, [(label, points), ...]).
+
+    Sizes missing from the annotation, or of images without one, come from the image header.
+    """
+    width, height, shapes = None, None, []
+    if json_path:
+        with open(json_path, 'r', encoding='utf-8') as jf:
+            annotation = json.load(jf)
+        shapes = [
+            (shape.get("label", ""), np.asarray(shape.get("points", []), dtype=np.float32).reshape(-1, 2))
+            for shape in annotation.get("shapes", [])
+        ]
+        width, height = annotation.get("imageWidth"), annotation.get("imageHeight")
+    if width is None or height is None:
+        width, height = probe_size(img_path)
+    return width, height, shapes
+
+def parse_annotations(image_paths, json_paths, max_workers=None):
+    """Parse the annotation of every image once, in parallel. Returns {image path: parsed}."""
+    annotations = {}
+    with process_pool(max_workers) as executor:
+        parsed = executor.map(parse_annotation, image_paths, [json_paths.get(img_path) for img_path in image_paths], chunksize=64)
+        for img_path, annotation in tqdm(zip(image_paths, parsed), total=len(image_paths), desc="Parsing annotations"):
+            annotations[img_path] = annotation
+    return annotations
+
+def export_annotations(image_paths, annotations, export_dir):
+    """Write all polygons as memory-mappable NumPy columns plus an index by image filename.
+
+    Polygon i of image j has label labels[polygon_labels[i]] and vertices
+    coords[polygon_offsets[i]:polygon_offsets[i + 1]]; the polygons of image j are
+    image_offsets[j]:image_offsets[j + 1].
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    label_ids = {}
+    coords, polygon_offsets, polygon_labels = [], [0], []
+    image_offsets, image_sizes, filenames = [0], [], []
+
+    for img_path in image_paths:
+        width, height, shapes = annotations.get(img_path, (None, None, []))
+        for label, points in shapes:
+            coords.append(points)
+            polygon_offsets.append(polygon_offsets[-1] + len(points))
+            polygon_labels.append(label_ids.setdefault(label, len(label_ids)))
+        image_offsets.append(len(polygon_labels))
+        image_sizes.append((width or 0, height or 0))
+        filenames.append(os.path.basename(img_path))
+
+    arrays = {
+        "coords": np.concatenate(coords) if coords else np.zeros((0, 2), dtype=np.float32),
+        "polygon_offsets": np.asarray(polygon_offsets, dtype=np.int64),
+        "polygon_labels": np.asarray(polygon_labels, dtype=np.int32),
+        "image_offsets": np.asarray(image_offsets, dtype=np.int64),
+        "image_sizes": np.asarray(image_sizes, dtype=np.int32).reshape(-1, 2)
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(export_dir, f"{name}.npy"), array)
+
+    index = {
+        "labels": list(label_ids),
+        "images": {fname: position for position, fname in enumerate(filenames)},
+        "arrays": {name: f"{name}.npy" for name in arrays}
+    }
+    with open(os.path.join(export_dir, "index.json"), 'w', encoding='utf-8') as index_file:
+        json.dump(index, index_file, indent=4)
+
+    logging.info(f"Exported {len(polygon_labels)} polygons of {len(filenames)} images to {export_dir}.")
+
+def load_annotations(export_dir):
+    """Open an annotation export with every column memory-mapped."""
+    with open(os.path.join(export_dir, "index.json"), 'r', encoding='utf-8') as index_file:
+        index = json.load(index_file)
+    export = {name: np.load(os.path.join(export_dir, file), mmap_mode='r') for name, file in index["arrays"].items()}
+    export["labels"] = index["labels"]
+    export["images"] = index["images"]
+    return export
+
+def image_annotations(export, fname):
+    """(label, points) pairs of one image, sliced from a loaded export."""
+    position = export["images"][fname]
+    start, end = export["image_offsets"][position], export["image_offsets"][position + 1]
+    offsets = export["polygon_offsets"]
+    return [
+        (export["labels"][export["polygon_labels"][i]], export["coords"][offsets[i]:offsets[i + 1]])
+        for i in range(start, end)
+    ]
+
+def generate_metadata(image_paths, json_paths, output_dir, annotations=None):
     logging.info("Generating metadata for selected images...")
     for img_path in tqdm(image_paths, desc="Generating metadata"):
         fname = os.path.basename(img_path)
@@ -72,7 +171,9 @@ def generate_metadata(image_paths, json_paths, output_dir):
         json_annotation_path = json_paths.get(img_path)
 
         # Extract resolution from the JSON annotation file
-        if json_annotation_path:
+        if annotations is not None and img_path in annotations:
+            width, height, _ = annotations[img_path]
+        elif json_annotation_path:
             with open(json_annotation_path, 'r', encoding='utf-8') as jf:
                 annotation = json.load(jf)
                 width = annotation.get("imageWidth")
@@ -80,11 +181,8 @@ def generate_metadata(image_paths, json_paths, output_dir):
 
         # If JSON not available or failed, fall back to PIL
         if width is None or height is None:
-            try:
-                with Image.open(img_path) as img:
-                    width, height = img.size
-            except Exception as e:
-                print(f"Failed to open image {fname}: {e}")
+            width, height = probe_size(img_path)
+            if width is None:
                 continue  # skip if image is corrupted
 
         metadata = {
@@ -100,12 +198,11 @@ def generate_metadata(image_paths, json_paths, output_dir):
             }
         }
 
-        with open(metadata_path, 'w', encoding='utf-8') as meta_file:
-            json.dump(metadata, meta_file, indent=4)
+        catalog.write_metadata(metadata_path, metadata)
 
     logging.info("Metadata generation completed.")
 
-def download_irf_images(max_images, output_dir, download_data, extract_data):
+def download_irf_images(max_images, output_dir, download_data, extract_data, materialize_mode="copy", max_workers=1, export_annotations_data=False, process_workers=None):
     api = authenticate_kaggle()
 
     if download_data:
@@ -119,7 +216,16 @@ def download_irf_images(max_images, output_dir, download_data, extract_data):
     selected_images, annotations_map = collect_jpg_images_and_json(
         extracted_path=EXTRACTED_PATH,
         max_images_total=max_images,
-        output_dir=output_dir
+        output_dir=output_dir,
+        materialize_mode=materialize_mode,
+        max_workers=max_workers
     )
 
-    generate_metadata(selected_images, annotations_map, output_dir)
\ No newline at end of file
+    annotations = None
+    if export_annotations_data:
+        annotations = parse_annotations(selected_images, annotations_map, process_workers)
+        export_annotations(selected_images, annotations, os.path.join(output_dir, ANNOTATIONS_DIR))
+
+    generate_metadata(selected_images, annotations_map, output_dir, annotations)
+
+    return len(selected_images)
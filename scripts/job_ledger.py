@@ -0,0 +1,101 @@
+import time
+import sqlite3
+import threading
+import logging
+
+# Failed items are retried after BACKOFF_SECONDS * 2**(attempts - 1), up to MAX_ATTEMPTS
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 60
+
+PENDING = "pending"
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+_connection = None
+_lock = threading.Lock()
+
+def configure(db_path):
+    """Open (or create) the ledger database at db_path."""
+    global _connection
+    connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            source TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (source, item_id)
+        )
+    """)
+    with _lock:
+        _connection = connection
+    logging.info(f"Job ledger enabled at {db_path}.")
+
+def is_enabled():
+    return _connection is not None
+
+def get_status(source, item_id):
+    if _connection is None:
+        return None
+    with _lock:
+        row = _connection.execute(
+            "SELECT status FROM jobs WHERE source = ? AND item_id = ?", (source, str(item_id))
+        ).fetchone()
+    return row[0] if row else None
+
+def should_run(source, item_id):
+    """True unless the item is finished, out of attempts or still backing off."""
+    if _connection is None:
+        return True
+    with _lock:
+        row = _connection.execute(
+            "SELECT status, attempts, updated_at FROM jobs WHERE source = ? AND item_id = ?", (source, str(item_id))
+        ).fetchone()
+    if row is None:
+        return True
+
+    status, attempts, updated_at = row
+    if status in (DONE, SKIPPED):
+        return False
+    if status == FAILED:
+        if attempts >= MAX_ATTEMPTS:
+            return False
+        return time.time() >= updated_at + BACKOFF_SECONDS * 2 ** (attempts - 1)
+    return True
+
+def _record(source, item_id, status, error=None, count_attempt=True):
+    if _connection is None:
+        return
+    with _lock:
+        _connection.execute("""
+            INSERT INTO jobs (source, item_id, status, attempts, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (source, item_id) DO UPDATE SET
+                status = excluded.status,
+                attempts = jobs.attempts + excluded.attempts,
+                error = excluded.error,
+                updated_at = excluded.updated_at
+        """, (source, str(item_id), status, int(count_attempt), error, time.time()))
+
+def mark_pending(source, item_id):
+    _record(source, item_id, PENDING, count_attempt=False)
+
+def mark_done(source, item_id):
+    _record(source, item_id, DONE)
+
+def mark_skipped(source, item_id):
+    _record(source, item_id, SKIPPED)
+
+def mark_failed(source, item_id, error):
+    _record(source, item_id, FAILED, error=str(error))
+
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
@@ -0,0 +1,97 @@
+import re
+import threading
+from functools import lru_cache
+from langdetect import DetectorFactory, detect, LangDetectException
+
+# langdetect samples randomly; a fixed seed makes results reproducible
+DetectorFactory.seed = 0
+
+FILE_EXTENSION_PATTERN = re.compile(r"\.(jpe?g|png|gif|svg|tiff?|webp|bmp|pdf|ogg|ogv|webm|djvu|stl)$", re.IGNORECASE)
+TOKEN_PATTERN = re.compile(r"[^\W\d_]+")
+
+# Camera and phone default names carry no language: IMG_1234, DSC01234, P1010001, DJI_0042, 20190712_101530
+CAMERA_NAME_PATTERN = re.compile(
+    r"^(img|dsc|dscn|dscf|dsci|dcim|pict|pano|dji|gopr|mvi|imag|pxl|cimg|sam|sdc|photo|p)?[\s_\-]*\d[\d\s_\-()]*$",
+    re.IGNORECASE
+)
+
+# Common English words, including the domain vocabulary of the Commons categories we crawl.
+# Titles made only of these words are classified without running langdetect.
+ENGLISH_WORDS = frozenset("""
+a an the and or of in on at to from for with by near over under into onto off out up down
+is are was were be been being has have had this that these those it its their his her our
+new old big small large main north south east west northern southern eastern western central
+upper lower front back side top bottom view views aerial panorama panoramic night day morning
+evening sunset sunrise winter summer spring autumn fall detail closeup close interior exterior
+building buildings house houses home homes roof roofs wall walls window windows door street
+road bridge tower towers city town village station stations plant plants power energy
+electric electrical electricity solar panel panels photovoltaic array arrays cell cells
+module modules wind turbine turbines farm farms park parks offshore onshore blade blades
+hydro hydroelectric dam dams water river lake sea coast nuclear reactor reactors cooling
+coal gas natural oil fuel fuels biomass biofuel biofuels geothermal heat heating pump pumps
+storage battery batteries grid grids smart meter meters substation substations transformer
+transformers transmission line lines pole poles pylon pylons cable cables control room rooms
+system systems monitoring management efficiency efficient label labels appliance appliances
+lighting lamp lamps led bulb bulbs light lights hvac ventilation air conditioner conditioning
+insulation green zero carbon capture hydrogen vehicle vehicles car cars bus buses charging
+charger chargers construction site sites factory industrial industry manufacturing district
+thermal collector collectors steam chimney boiler boilers generator generators engine
+satellite image images picture pictures photo photograph map maps diagram chart
+renewable renewables transition infrastructure microgrid microgrids
+demand response virtual emission emissions pipeline pipelines refinery tank tanks
+international national university project company museum works
+""".split())
+
+_detector_lock = threading.Lock()
+_detector_ready = False
+
+def _init_detector():
+    # langdetect loads its language profiles lazily and not thread-safely,
+    # so the first load happens here, once, under a lock
+    global _detector_ready
+    if _detector_ready:
+        return
+    with _detector_lock:
+        if not _detector_ready:
+            try:
+                detect("warm up the language profiles")
+            except LangDetectException:
+                pass
+            _detector_ready = True
+
+def normalize_title(title):
+    """Strip the File: prefix, word separators and the extension from a file title."""
+    title = title.replace("File:", "").replace("_", " ").replace("-", " ")
+    title = FILE_EXTENSION_PATTERN.sub("", title.strip())
+    return title
+
+def title_tokens(title):
+    """Lower-case words of a normalised title."""
+    return TOKEN_PATTERN.findall(normalize_title(title).lower())
+
+@lru_cache(maxsize=100000)
+def is_english_title(title):
+    """True if a file title reads as English. Camera default names are not.
+
+    Titles made only of dictionary words skip langdetect; the others are
+    detected as given, and every result is memoised by title.
+    """
+    if CAMERA_NAME_PATTERN.match(normalize_title(title)):
+        return False
+
+    # Fast path: plain ASCII dictionary words
+    tokens = title_tokens(title)
+    if not tokens:
+        return False
+    if all(token.isascii() and token in ENGLISH_WORDS for token in tokens):
+        return True
+
+    _init_detector()
+    try:
+        return detect(title) == "en"
+    except LangDetectException:
+        return False
+
+def is_english_titles(titles):
+    """is_english_title for each title; langdetect has no batch mode, so each runs on its own."""
+    return [is_english_title(title) for title in titles]
@@ -0,0 +1,76 @@
+import os
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+# How a dataset file is placed in the output tree
+MODES = ("copy", "hardlink", "reflink", "symlink")
+
+# ioctl request for a copy-on-write clone (Btrfs, XFS, bcachefs; OCFS2 via the same call)
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """Clone src into dst sharing its data blocks. Raises OSError if unsupported."""
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+def materialize_file(src, dst, mode="copy"):
+    """Place src at dst (a file or directory path) using mode.
+
+    Hardlinks and reflinks fall back to a real copy when the filesystem cannot
+    provide them, e.g. across devices. Returns (mode used, bytes not copied).
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown materialise mode: {mode}")
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        os.remove(dst)
+    size = os.path.getsize(src)
+
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hardlink", size
+        except OSError as e:
+            logging.debug(f"Hardlink failed for {src} ({e}), copying instead.")
+    elif mode == "reflink":
+        try:
+            reflink(src, dst)
+            return "reflink", size
+        except OSError as e:
+            logging.debug(f"Reflink failed for {src} ({e}), copying instead.")
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+        return "symlink", size
+
+    shutil.copy(src, dst)
+    return "copy", 0
+
+def materialize_files(pairs, mode="copy", max_workers=1):
+    """Materialise (src, dst) pairs in parallel and log how many bytes were not copied.
+
+    Returns a dict with the number of files per mode used and the bytes saved.
+    """
+    pairs = list(pairs)
+    summary = {"files": {}, "bytes_saved": 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for used_mode, saved in executor.map(lambda pair: materialize_file(pair[0], pair[1], mode), pairs):
+            summary["files"][used_mode] = summary["files"].get(used_mode, 0) + 1
+            summary["bytes_saved"] += saved
+
+    counts = ", ".join(f"{count} {used_mode}" for used_mode, count in sorted(summary["files"].items()))
+    logging.info(f"Materialised {len(pairs)} files ({counts or 'none'}), {summary['bytes_saved'] / 1024 ** 2:.1f} MB not copied.")
+    return summary
@@ -1,15 +1,10 @@
-import requests
 import os
-import json
+import threading
 from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
-from PIL import Image, ImageFile
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import feedparser
 import logging
-
-# Allow truncated images
-ImageFile.LOAD_TRUNCATED_IMAGES = True
+from scripts import catalog, html_extract, http_client, image_io
 
 # RSS feeds to parse recent images
 RSS_FEEDS = [
@@ -21,27 +16,58 @@ RSS_FEEDS = [
 TOPICS = {"heat", "atmosphere", "land"}
 CUTOFF_DATE = datetime.today() - timedelta(days=10*365)
 
-headers = {
-    "User-Agent": "mAiEnergyBot/1.0 (kosmylo@gmail.com; downloading NASA Earth Observatory images for research)"
-}
-
-def download_nasa_image(entry_url, topics, cutoff_date, output_dir):
-    response = requests.get(entry_url, headers=headers)
+class ImageQuota:
+    """Image slots shared by the download workers, so the run stops at exactly max_images.
+
+    A slot is reserved before an image download, then confirmed once the image
+    is saved or released if it fails. While the open slots are all reserved,
+    workers wait for the outcome instead of giving up, since a failure frees one.
+    """
+
+    def __init__(self, max_images):
+        self.max_images = max_images
+        self.saved = 0
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def claim(self):
+        with self.condition:
+            while self.saved < self.max_images <= self.saved + self.reserved:
+                self.condition.wait()
+            if self.saved >= self.max_images:
+                return False
+            self.reserved += 1
+            return True
+
+    def confirm(self):
+        with self.condition:
+            self.reserved -= 1
+            self.saved += 1
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.reserved -= 1
+            self.condition.notify_all()
+
+    def full(self):
+        with self.condition:
+            return self.saved >= self.max_images
+
+def download_nasa_image(entry_url, topics, cutoff_date, output_dir, convert_to=None, quota=None):
+    response = http_client.get(entry_url)
     if response.status_code != 200:
         logging.error(f"Failed to access {entry_url}: HTTP {response.status_code}")
         return False
 
-    soup = BeautifulSoup(response.content, "html.parser")
+    article = html_extract.nasa_article(response.content, response.headers.get("Content-Type"))
 
     # Extract title
-    title_tag = soup.find("h1")
-    title = title_tag.get_text(strip=True) if title_tag else "untitled"
+    title = article["title"]
 
     # Extract publication date
-    pub_date_tag = soup.find(lambda tag: tag.name == "p" and "Published" in tag.text)
-    if pub_date_tag:
-        pub_date_str = pub_date_tag.text.replace("Published", "").strip()
-        pub_date = datetime.strptime(pub_date_str, "%b %d, %Y")
+    if article["published"] is not None:
+        pub_date = datetime.strptime(article["published"], "%b %d, %Y")
         if pub_date < cutoff_date:
             logging.info(f"Skipping {title}: older than cutoff date.")
             return False
@@ -49,44 +75,51 @@ def download_nasa_image(entry_url, topics, cutoff_date, output_dir):
         pub_date = datetime.today()
 
     # Extract categories
-    categories = set()
-    for cat_tag in soup.find_all("a", href=lambda h: h and '/topic/' in h):
-        cat_text = cat_tag.text.strip().lower()
-        if cat_text in topics:
-            categories.add(cat_text)
+    categories = {topic for topic in article["topics"] if topic in topics}
 
     if not categories:
         logging.info(f"Skipping {title}: does not match topics.")
         return False
 
     # Find high-res image link
-    image_link_tag = soup.find("a", string=["JPEG", "PNG"])
-    if not image_link_tag:
+    if not article["image_url"]:
         logging.warning(f"No high-res image found for {title}")
         return False
 
-    image_url = image_link_tag['href']
-    img_response = requests.get(image_url, headers=headers)
+    # Reserve an image slot before downloading, so workers never overshoot max_images
+    if quota is not None and not quota.claim():
+        return False
+    success = False
+    try:
+        success = save_nasa_image(title, categories, article["image_url"], article["caption"], entry_url, output_dir, convert_to)
+    finally:
+        if quota is not None:
+            if success:
+                quota.confirm()
+            else:
+                quota.release()
+    return success
+
+def save_nasa_image(title, categories, image_url, caption, entry_url, output_dir, convert_to=None):
+    img_response = http_client.get(image_url, stream=True)
     if img_response.status_code != 200:
         logging.error(f"Failed to download image for {title}")
+        img_response.close()
         return False
 
     image_format = image_url.split(".")[-1]
-    image = Image.open(BytesIO(img_response.content))
-    resolution = f"{image.width}x{image.height}"
 
     # Prepare directories
     topic_dir = os.path.join(output_dir, "_".join(sorted(categories)))
     os.makedirs(topic_dir, exist_ok=True)
 
-    # Save image
+    # Save image bytes as downloaded, reading the size from the header
     image_file_name = f"{title.replace(' ', '_').replace('/', '_')}.{image_format}"
     image_path = os.path.join(topic_dir, image_file_name)
-    image.save(image_path)
-
-    # Extract caption
-    caption_tag = soup.find("img", alt=True)
-    caption = caption_tag["alt"] if caption_tag else ""
+    image_path, width, height, _ = image_io.save_image(img_response, image_path, convert_to)
+    image_file_name = os.path.basename(image_path)
+    image_format = os.path.splitext(image_file_name)[1].lstrip(".")
+    resolution = f"{width}x{height}"
 
     # Metadata structure
     metadata = {
@@ -110,29 +143,74 @@ def download_nasa_image(entry_url, topics, cutoff_date, output_dir):
     # Save metadata
     metadata_file_name = image_file_name.rsplit(".", 1)[0] + ".json"
     metadata_path = os.path.join(topic_dir, metadata_file_name)
-    with open(metadata_path, 'w') as json_file:
-        json.dump(metadata, json_file, indent=4)
+    catalog.write_metadata(metadata_path, metadata)
 
     logging.info(f"Downloaded and saved: {title}")
     return True
 
-def download_nasa_images(max_images, output_dir):
-    collected_images = 0
-    visited_links = set()
+def fetch_feed(feed_url):
+    try:
+        response = http_client.get(feed_url)
+        response.raise_for_status()
+        return feedparser.parse(response.content).entries
+    except Exception as e:
+        logging.error(f"Failed to fetch feed {feed_url}: {e}")
+        return []
+
+def entry_matches(entry, topics, cutoff_date):
+    """Prefilter a feed entry on its published date and tags, before any page request.
+
+    Entries without a date or tags are kept and decided on their article page.
+    """
+    published = entry.get("published_parsed")
+    if published and datetime(*published[:6]) < cutoff_date:
+        return False
+    tags = {tag.get("term", "").strip().lower() for tag in entry.get("tags", [])}
+    if tags and not tags & topics:
+        return False
+    return True
 
-    for feed_url in RSS_FEEDS:
-        feed = feedparser.parse(feed_url)
-        for entry in feed.entries:
-            if collected_images >= max_images:
-                break
-            entry_link = entry.link
-            if entry_link not in visited_links:
-                visited_links.add(entry_link)
-                success = download_nasa_image(entry_link, TOPICS, CUTOFF_DATE, output_dir)
-                if success:
-                    collected_images += 1
+def download_nasa_images(max_images, output_dir, convert_to=None, max_workers=1):
+    # Feeds are fetched concurrently and read in their listed order
+    with ThreadPoolExecutor(max_workers=len(RSS_FEEDS)) as executor:
+        feeds = list(executor.map(fetch_feed, RSS_FEEDS))
 
-        if collected_images >= max_images:
-            break
+    entry_links = []
+    visited_links = set()
+    skipped = 0
+    for entries in feeds:
+        for entry in entries:
+            if entry.link in visited_links:
+                continue
+            visited_links.add(entry.link)
+            if entry_matches(entry, TOPICS, CUTOFF_DATE):
+                entry_links.append(entry.link)
+            else:
+                skipped += 1
+    logging.info(f"NASA feeds: {len(entry_links)} candidate articles, {skipped} dropped by date or topic.")
+
+    quota = ImageQuota(max_images)
+
+    def collect(done):
+        for future in done:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Failed to process NASA article: {e}")
+
+    # Candidates keep being submitted until max_images are saved: a reserved
+    # slot whose download fails is released and taken by a later candidate
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+        for entry_link in entry_links:
+            while len(in_flight) >= max_workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            if quota.full():
+                break
+            in_flight.add(executor.submit(download_nasa_image, entry_link, TOPICS, CUTOFF_DATE, output_dir, convert_to, quota))
+        collect(wait(in_flight)[0])
 
-    logging.info(f"Completed downloading {collected_images} NASA Earth Observatory images.")
\ No newline at end of file
+    collected_images = quota.saved
+    logging.info(f"Completed downloading {collected_images} NASA Earth Observatory images.")
+    return collected_images
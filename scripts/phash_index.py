@@ -0,0 +1,286 @@
+import os
+import re
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image, ImageFile
+from scripts import catalog
+
+# Allow truncated images
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+
+# dHash compares neighbouring pixels of a 9x8 thumbnail, pHash keeps the
+# low 8x8 DCT frequencies of a 32x32 thumbnail. Both give 64-bit hashes.
+DHASH_SIZE = 8
+PHASH_SIZE = 32
+PHASH_LOW_FREQ = 8
+
+# Outputs derived from a source image: INRIA chips and ground-truth masks,
+# and the lower DPI renditions of an EPREL label
+DERIVED_DIRS = {"chips", "gt"}
+RENDITION_PATTERN = re.compile(r"_\d+dpi$")
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+DCT_MATRIX = _dct_matrix(PHASH_SIZE)
+
+def _pack_bits(bits):
+    """Pack an (N, 64) boolean array into N unsigned 64-bit integers."""
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+def dhash_batch(thumbnails):
+    """dHash of an (N, 8, 9) float array of grayscale thumbnails."""
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    return _pack_bits(bits.reshape(len(thumbnails), -1))
+
+def phash_batch(thumbnails):
+    """pHash of an (N, 32, 32) float array of grayscale thumbnails."""
+    dct = np.einsum("ij,njk,lk->nil", DCT_MATRIX, thumbnails, DCT_MATRIX)
+    low = dct[:, :PHASH_LOW_FREQ, :PHASH_LOW_FREQ].reshape(len(thumbnails), -1)
+    # Median of the low frequencies without the DC term
+    medians = np.median(low[:, 1:], axis=1, keepdims=True)
+    return _pack_bits(low > medians)
+
+def load_thumbnails(path):
+    """Decode an image once into the grayscale thumbnails both hashes need."""
+    with Image.open(path) as img:
+        # JPEG decoders can downscale while decoding
+        img.draft("L", (PHASH_SIZE * 4, PHASH_SIZE * 4))
+        gray = img.convert("L")
+        dhash_thumb = np.asarray(gray.resize((DHASH_SIZE + 1, DHASH_SIZE), Image.LANCZOS), dtype=np.float32)
+        phash_thumb = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float32)
+    return dhash_thumb, phash_thumb
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for Hamming-radius queries."""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, hash_value, item):
+        node = [hash_value, item, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def query(self, hash_value, radius):
+        """Return (distance, item) for every hash within radius."""
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_hash, item, children = stack.pop()
+            distance = hamming(hash_value, node_hash)
+            if distance <= radius:
+                results.append((distance, item))
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return results
+
+def iter_image_files(root):
+    for dirpath, _, files in os.walk(root):
+        for file in sorted(files):
+            if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(dirpath, file)
+
+def item_key(rel_path):
+    """The source item an image belongs to; renditions share their source's key."""
+    return RENDITION_PATTERN.sub("", os.path.splitext(rel_path)[0])
+
+def iter_source_images(root):
+    """Downloaded source images: images with metadata, skipping derived outputs."""
+    for path in iter_image_files(root):
+        rel_path = os.path.relpath(path, root)
+        if DERIVED_DIRS.intersection(rel_path.split(os.sep)[:-1]):
+            continue
+        if item_key(rel_path) != os.path.splitext(rel_path)[0]:
+            continue
+        metadata_path = os.path.splitext(path)[0] + ".json"
+        if os.path.exists(metadata_path) or catalog.read_metadata(metadata_path) is not None:
+            yield path
+
+def load_index(index_path):
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r', encoding='utf-8') as index_file:
+        return json.load(index_file).get("entries", {})
+
+def save_index(index_path, entries):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as index_file:
+        json.dump({"entries": entries}, index_file)
+    os.replace(tmp_path, index_path)
+
+def hash_files(paths, batch_size=256, max_workers=4):
+    """Yield (path, dhash, phash) for each image, hashing in vectorised batches."""
+    def load(path):
+        try:
+            return path, load_thumbnails(path)
+        except Exception as e:
+            logging.warning(f"Cannot hash {path}: {e}")
+            return path, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(paths), batch_size):
+            loaded = [item for item in executor.map(load, paths[start:start + batch_size]) if item[1] is not None]
+            if not loaded:
+                continue
+            dhashes = dhash_batch(np.stack([thumbs[0] for _, thumbs in loaded]))
+            phashes = phash_batch(np.stack([thumbs[1] for _, thumbs in loaded]))
+            for (path, _), dhash, phash in zip(loaded, dhashes, phashes):
+                yield path, int(dhash), int(phash)
+
+def flagged_as(path):
+    """The image a source image was flagged as a near-duplicate of, if any."""
+    metadata = catalog.read_metadata(os.path.splitext(path)[0] + ".json")
+    return (metadata or {}).get("additional_info", {}).get("near_duplicate_of")
+
+def update_index(root, index_path, batch_size=256, max_workers=4):
+    """Hash source images that are new or changed since the last run; drop the others.
+
+    Returns the entries and the relative paths hashed in this run.
+    """
+    entries = load_index(index_path)
+    current = {}
+    to_hash = []
+    for path in iter_source_images(root):
+        rel_path = os.path.relpath(path, root)
+        mtime = os.path.getmtime(path)
+        entry = entries.get(rel_path)
+        if entry and entry["mtime"] == mtime:
+            current[rel_path] = entry
+        else:
+            to_hash.append(path)
+
+    logging.info(f"Perceptual hash index: {len(current)} cached, {len(to_hash)} to hash.")
+    new_paths = []
+    for path, dhash, phash in hash_files(to_hash, batch_size, max_workers):
+        rel_path = os.path.relpath(path, root)
+        current[rel_path] = {
+            "mtime": os.path.getmtime(path),
+            "size": os.path.getsize(path),
+            "dhash": f"{dhash:016x}",
+            "phash": f"{phash:016x}"
+        }
+        keep = flagged_as(path)
+        if keep:
+            current[rel_path]["near_duplicate_of"] = keep
+        new_paths.append(rel_path)
+
+    save_index(index_path, current)
+    return current, new_paths
+
+def build_tree(entries):
+    tree = BKTree()
+    for rel_path, entry in entries.items():
+        tree.add(int(entry["phash"], 16), rel_path)
+    return tree
+
+def query_tree(dhash, phash, entries, tree, radius=6):
+    """Indexed images whose pHash and dHash are both within radius bits."""
+    return [rel_path for _, rel_path in tree.query(phash, radius) if hamming(dhash, int(entries[rel_path]["dhash"], 16)) <= radius]
+
+def check_image(path, entries, tree, radius=6):
+    """Near-duplicates of a newly downloaded image among the indexed ones."""
+    dhash_thumb, phash_thumb = load_thumbnails(path)
+    dhash = int(dhash_batch(dhash_thumb[None])[0])
+    phash = int(phash_batch(phash_thumb[None])[0])
+    return query_tree(dhash, phash, entries, tree, radius)
+
+def find_near_duplicates(entries, new_paths=None, radius=6):
+    """Group the new images with the indexed images they nearly duplicate.
+
+    Only new_paths (every entry if None) are queried; pairs of older images
+    were compared when the newer of them was indexed. Images already flagged
+    as near-duplicates and images of the same item (see item_key) are never
+    matched. Each group keeps its largest file and lists the others as
+    duplicates.
+    """
+    candidates = {rel_path: entry for rel_path, entry in entries.items() if "near_duplicate_of" not in entry}
+    tree = build_tree(candidates)
+    queried = candidates if new_paths is None else [rel_path for rel_path in new_paths if rel_path in candidates]
+    parent = {}
+
+    def find(item):
+        parent.setdefault(item, item)
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    for rel_path in queried:
+        entry = candidates[rel_path]
+        for other in query_tree(int(entry["dhash"], 16), int(entry["phash"], 16), candidates, tree, radius):
+            if item_key(other) != item_key(rel_path):
+                parent[find(other)] = find(rel_path)
+
+    groups = {}
+    for rel_path in list(parent):
+        groups.setdefault(find(rel_path), []).append(rel_path)
+
+    duplicates = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        members.sort(key=lambda rel_path: (-entries[rel_path]["size"], rel_path))
+        duplicates.append({"keep": members[0], "duplicates": members[1:]})
+    return duplicates
+
+def flag_duplicate(root, rel_path, keep):
+    metadata_path = os.path.splitext(os.path.join(root, rel_path))[0] + ".json"
+    metadata = catalog.read_metadata(metadata_path)
+    if metadata is None or metadata.get("additional_info", {}).get("near_duplicate_of"):
+        return
+    metadata.setdefault("additional_info", {})["near_duplicate_of"] = keep
+    catalog.write_metadata(metadata_path, metadata)
+
+def remove_duplicate(root, rel_path):
+    image_path = os.path.join(root, rel_path)
+    if os.path.exists(image_path):
+        os.remove(image_path)
+    catalog.remove_metadata(os.path.splitext(image_path)[0] + ".json")
+
+def dedupe_images(root="output/images", index_path="output/phash_index.json", radius=6, action="flag", report_path="output/near_duplicates.json", batch_size=256, max_workers=4):
+    """Find near-duplicates of the newly indexed images across all sources and flag or remove them."""
+    logging.info(f"Starting near-duplicate detection in {root} (radius {radius}, action {action}).")
+    entries, new_paths = update_index(root, index_path, batch_size, max_workers)
+    groups = find_near_duplicates(entries, new_paths, radius)
+
+    with open(report_path, 'w', encoding='utf-8') as report_file:
+        json.dump(groups, report_file, indent=4)
+
+    duplicates = 0
+    for group in groups:
+        for rel_path in group["duplicates"]:
+            duplicates += 1
+            if action == "remove":
+                remove_duplicate(root, rel_path)
+                entries.pop(rel_path, None)
+            else:
+                flag_duplicate(root, rel_path, group["keep"])
+                entries[rel_path]["near_duplicate_of"] = group["keep"]
+
+    if groups:
+        save_index(index_path, entries)
+
+    logging.info(f"Near-duplicate detection complete: {duplicates} duplicates in {len(groups)} groups, report in {report_path}.")
+    return duplicates
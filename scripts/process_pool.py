@@ -0,0 +1,13 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Sources run on threads, and forking a process while other threads hold
+# locks or connections can deadlock the child. Workers are started from a
+# clean forkserver process instead (spawn where forkserver is unavailable),
+# so their tasks must be module-level functions with picklable arguments.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def process_pool(max_workers=None):
+    """A process pool of max_workers processes (default: one per CPU core)."""
+    return ProcessPoolExecutor(max_workers=max_workers or os.cpu_count() or 1, mp_context=multiprocessing.get_context(START_METHOD))
@@ -0,0 +1,151 @@
+import os
+import io
+import json
+import random
+import tarfile
+import logging
+from concurrent.futures import as_completed
+from scripts import catalog
+from scripts.phash_index import iter_image_files
+from scripts.process_pool import process_pool
+
+SHARD_PREFIX = "shard"
+INDEX_FILE = "index.json"
+
+# Tar header per member plus worst-case padding, used to plan shard sizes
+TAR_MEMBER_OVERHEAD = 1024
+
+def sample_key(rel_path):
+    """WebDataset key of an image: its path without extension, free of dots and slashes."""
+    return os.path.splitext(rel_path)[0].replace(os.sep, "/").replace(".", "_").replace("/", "__")
+
+def load_shard_index(shards_dir):
+    index_path = os.path.join(shards_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return {"shards": []}
+    with open(index_path, 'r', encoding='utf-8') as index_file:
+        return json.load(index_file)
+
+def save_shard_index(shards_dir, index):
+    index_path = os.path.join(shards_dir, INDEX_FILE)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as index_file:
+        json.dump(index, index_file, indent=4)
+    os.replace(tmp_path, index_path)
+
+def collect_samples(root, packed_keys):
+    """Images under root with metadata that are not in a shard yet.
+
+    Returns (key, image path, metadata path or None, metadata bytes or None, size)
+    tuples; metadata bytes are only set when the metadata lives in the catalog.
+    """
+    samples = []
+    for image_path in iter_image_files(root):
+        key = sample_key(os.path.relpath(image_path, root))
+        if key in packed_keys:
+            continue
+        metadata_path = os.path.splitext(image_path)[0] + ".json"
+        if os.path.exists(metadata_path):
+            metadata_bytes = None
+            metadata_size = os.path.getsize(metadata_path)
+        else:
+            metadata = catalog.read_metadata(metadata_path)
+            if metadata is None:
+                continue
+            metadata_bytes = json.dumps(metadata).encode("utf-8")
+            metadata_path = None
+            metadata_size = len(metadata_bytes)
+        size = os.path.getsize(image_path) + metadata_size + 2 * TAR_MEMBER_OVERHEAD
+        samples.append((key, image_path, metadata_path, metadata_bytes, size))
+    return samples
+
+def plan_shards(samples, max_shard_bytes, max_shard_samples=None):
+    """Split samples, in order, into shards of at most max_shard_bytes (and max_shard_samples)."""
+    shards = []
+    current, current_bytes = [], 0
+    for sample in samples:
+        full = current and (
+            current_bytes + sample[4] > max_shard_bytes
+            or (max_shard_samples and len(current) >= max_shard_samples)
+        )
+        if full:
+            shards.append(current)
+            current, current_bytes = [], 0
+        current.append(sample)
+        current_bytes += sample[4]
+    if current:
+        shards.append(current)
+    return shards
+
+def write_shard(shard_path, samples):
+    """Write one tar shard of image + JSON pairs. Runs in a worker process.
+
+    Symlinked files (e.g. a dataset materialised with symlinks) are stored
+    with the data they point to.
+    """
+    tmp_path = shard_path + ".tmp"
+    with tarfile.open(tmp_path, 'w', dereference=True) as tar:
+        for key, image_path, metadata_path, metadata_bytes, _ in samples:
+            tar.add(image_path, arcname=key + os.path.splitext(image_path)[1].lower())
+            if metadata_path:
+                tar.add(metadata_path, arcname=key + ".json")
+            else:
+                info = tarfile.TarInfo(key + ".json")
+                info.size = len(metadata_bytes)
+                tar.addfile(info, io.BytesIO(metadata_bytes))
+    os.replace(tmp_path, shard_path)
+    return os.path.getsize(shard_path)
+
+def pack_shards(root="output/images", shards_dir="output/shards", max_shard_bytes=1024 ** 3, max_shard_samples=None, seed=0, max_workers=4):
+    """Pack every image/metadata pair not yet in a shard into new WebDataset tar shards.
+
+    New samples are shuffled deterministically (seed and first new shard number)
+    and written by parallel worker processes. Existing shards are never rewritten;
+    index.json lists every shard with its size and sample keys.
+    """
+    os.makedirs(shards_dir, exist_ok=True)
+    index = load_shard_index(shards_dir)
+    packed_keys = {key for shard in index["shards"] for key in shard["keys"]}
+
+    samples = collect_samples(root, packed_keys)
+    if not samples:
+        logging.info("No new samples to pack into shards.")
+        return 0
+
+    first_shard = len(index["shards"])
+    samples.sort(key=lambda sample: sample[0])
+    random.Random(f"{seed}:{first_shard}").shuffle(samples)
+    planned = plan_shards(samples, max_shard_bytes, max_shard_samples)
+    logging.info(f"Packing {len(samples)} new samples into {len(planned)} shards in {shards_dir}.")
+
+    written = {}
+    with process_pool(max_workers) as executor:
+        futures = {}
+        for number, shard_samples in enumerate(planned, start=first_shard):
+            name = f"{SHARD_PREFIX}-{number:06d}.tar"
+            futures[executor.submit(write_shard, os.path.join(shards_dir, name), shard_samples)] = (number, name, shard_samples)
+
+        for future in as_completed(futures):
+            number, name, shard_samples = futures[future]
+            try:
+                written[number] = {
+                    "name": name,
+                    "bytes": future.result(),
+                    "count": len(shard_samples),
+                    "keys": [sample[0] for sample in shard_samples]
+                }
+            except Exception as e:
+                logging.error(f"Failed to write shard {name}: {e}")
+
+    # Shards are indexed in order; after a failure the later ones are repacked next run
+    packed = 0
+    for number in range(first_shard, first_shard + len(planned)):
+        if number not in written:
+            break
+        index["shards"].append(written[number])
+        packed += written[number]["count"]
+    index["seed"] = seed
+    save_shard_index(shards_dir, index)
+
+    logging.info(f"Shard packing complete: {packed} samples in {len(index['shards']) - first_shard} new shards.")
+    return packed
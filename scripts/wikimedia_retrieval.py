@@ -1,49 +1,236 @@
-import requests
 import os
 import json
+import mimetypes
+import threading
+from collections import deque
 from datetime import datetime
 import logging
-from langdetect import detect, LangDetectException
+from concurrent.futures import ThreadPoolExecutor
+from scripts import catalog, http_client, image_io, job_ledger, language_filter
 
 # Wikimedia Commons API endpoint
 API_ENDPOINT = "https://commons.wikimedia.org/w/api.php"
 
-headers = {
-    "User-Agent": "mAiEnergyBot/1.0 (kosmylo@gmail.com; downloading images for research project)"
-}
+LEDGER_SOURCE = "wikimedia"
 
-def is_english_title(title):
-    try:
-        lang = detect(title)
-        return lang == 'en'
-    except LangDetectException:
-        return False
+# Most files the API will scale thumbnails for in one request
+THUMBNAIL_BATCH_SIZE = 50
+
+# download_image result for a file already downloaded for another category
+DUPLICATE = "duplicate"
+
+# SHA-1 of every file already on disk -> its metadata path, shared by all categories
+_hash_index = {}
+# SHA-1s found on disk by load_hash_index, i.e. saved by earlier runs
+_indexed_hashes = set()
+# SHA-1 -> categories of duplicates found while the first copy was still downloading
+_pending_categories = {}
+_hash_lock = threading.Lock()
+
+def iter_subcategories(category):
+    """Yield the names of the direct subcategories of a category."""
+    params = {
+        "action": "query",
+        "list": "categorymembers",
+        "cmtitle": f"Category:{category}",
+        "cmtype": "subcat",
+        "cmlimit": "max",
+        "format": "json"
+    }
+    continuation = {}
+    while True:
+        response = http_client.get(API_ENDPOINT, params={**params, **continuation})
+        response.raise_for_status()
+        data = response.json()
+
+        for member in data.get("query", {}).get("categorymembers", []):
+            yield member["title"].replace("Category:", "", 1)
+
+        if "continue" not in data:
+            break
+        continuation = data["continue"]
+
+def crawl_category_tree(category, max_depth=0, max_categories=50):
+    """Breadth-first walk of a category and its subcategories, root first.
+
+    Stops at max_depth levels below the root or after max_categories
+    categories, whichever comes first. Cycles in the category graph are skipped.
+    """
+    visited = {category}
+    frontier = deque([(category, 0)])
+    while frontier:
+        name, depth = frontier.popleft()
+        yield name
+
+        if depth >= max_depth:
+            continue
+        try:
+            for subcategory in iter_subcategories(name):
+                if len(visited) >= max_categories:
+                    break
+                if subcategory not in visited:
+                    visited.add(subcategory)
+                    frontier.append((subcategory, depth + 1))
+        except Exception as e:
+            logging.error(f"Error listing subcategories of '{name}': {e}")
+
+def iter_category_tree_images(category, target_max_side=None, max_depth=0, max_categories=50):
+    """Yield the files of a category tree, tagging each with the category it was found in."""
+    for name in crawl_category_tree(category, max_depth, max_categories):
+        for page in iter_category_images(name, target_max_side):
+            page["found_in"] = name
+            yield page
+
+def load_hash_index(output_dir):
+    """Index the SHA-1 of every Wikimedia file already on disk."""
+    with _hash_lock:
+        for root, _, files in os.walk(output_dir):
+            for file in files:
+                if not file.endswith(".json"):
+                    continue
+                metadata_path = os.path.join(root, file)
+                try:
+                    with open(metadata_path, 'r') as json_file:
+                        sha1 = json.load(json_file).get("additional_info", {}).get("sha1")
+                except (OSError, ValueError):
+                    continue
+                if sha1:
+                    _hash_index.setdefault(sha1, metadata_path)
+                    _indexed_hashes.add(sha1)
+        # Metadata kept only in the catalog when sidecars are off
+        for metadata_path, metadata in catalog.iter_metadata(output_dir):
+            sha1 = metadata.get("additional_info", {}).get("sha1")
+            if sha1:
+                _hash_index.setdefault(sha1, metadata_path)
+                _indexed_hashes.add(sha1)
+    logging.info(f"Indexed {len(_hash_index)} Wikimedia files already on disk.")
+
+def claim_hash(sha1, metadata_path):
+    """Reserve a SHA-1 for download. Returns the metadata path of an existing copy, or None."""
+    with _hash_lock:
+        existing = _hash_index.get(sha1)
+        if existing is None:
+            _hash_index[sha1] = metadata_path
+        return existing
+
+def lookup_hash(sha1):
+    with _hash_lock:
+        return _hash_index.get(sha1)
+
+def release_hash(sha1, metadata_path):
+    with _hash_lock:
+        if _hash_index.get(sha1) == metadata_path:
+            del _hash_index[sha1]
+
+def record_duplicate(sha1, existing_metadata_path, categories):
+    """Add the categories of a duplicate to the metadata of the copy already on disk.
+
+    If the first copy is still downloading, the categories are kept by hash
+    and added when its metadata is written.
+    """
+    with _hash_lock:
+        metadata = catalog.read_metadata(existing_metadata_path)
+        if metadata is None:
+            if not sha1:
+                return
+            pending = _pending_categories.setdefault(sha1, [])
+            pending.extend(category for category in categories if category not in pending)
+            return
+        known = metadata.setdefault("categories", [])
+        new = [category for category in categories if category not in known]
+        if new:
+            known.extend(new)
+            catalog.write_metadata(existing_metadata_path, metadata)
+
+def write_downloaded_metadata(sha1, metadata_path, metadata):
+    """Write the metadata of a new download with the categories its duplicates recorded meanwhile."""
+    with _hash_lock:
+        known = metadata["categories"]
+        known.extend(category for category in _pending_categories.get(sha1, []) if category not in known)
+        catalog.write_metadata(metadata_path, metadata)
+        _pending_categories.pop(sha1, None)
+
+def title_without_prefix(title):
+    return title.replace("File:", "").replace("_", " ").replace("-", " ")
+
+def iter_category_images(category, target_max_side=None):
+    """Yield every file of a category with its imageinfo, following API continuation.
 
-def search_images(category, limit=50):
+    Pages are requested lazily, so the caller stops further API calls simply
+    by not consuming the generator any more.
+    """
     params = {
         "action": "query",
         "generator": "categorymembers",
         "gcmtitle": f"Category:{category}",
         "gcmtype": "file",
-        "gcmlimit": limit,
+        "gcmlimit": "max",
         "prop": "imageinfo",
-        "iiprop": "url|size|mime",
+        "iiprop": "url|size|mime|sha1",
         "format": "json"
     }
-    response = requests.get(API_ENDPOINT, params=params, headers=headers)
-    response.raise_for_status()
-    data = response.json()
-    images = data.get("query", {}).get("pages", {}).values()
-    return list(images)
+    if target_max_side:
+        # Ask for a rendition that fits in a target_max_side box. The API scales
+        # at most THUMBNAIL_BATCH_SIZE files per request, so page at that size
+        params["iiurlwidth"] = target_max_side
+        params["iiurlheight"] = target_max_side
+        params["gcmlimit"] = THUMBNAIL_BATCH_SIZE
 
-def download_image(image_info, category, output_dir):
-    image_url = image_info['imageinfo'][0]['url']
-    image_name = image_url.split("/")[-1]
+    seen = set()
+    continuation = {}
+    while True:
+        response = http_client.get(API_ENDPOINT, params={**params, **continuation})
+        response.raise_for_status()
+        data = response.json()
 
-    title_no_prefix = image_info["title"].replace("File:", "").replace("_", " ").replace("-", " ")
+        # With imageinfo continuation a page may come back before its info does
+        pages = [
+            page for page in data.get("query", {}).get("pages", {}).values()
+            if "imageinfo" in page and page["pageid"] not in seen
+        ]
+
+        # Language of each title, memoised across pages and categories
+        titles = [title_without_prefix(page["title"]) for page in pages]
+        for page, is_english in zip(pages, language_filter.is_english_titles(titles)):
+            seen.add(page["pageid"])
+            page["is_english"] = is_english
+            yield page
+
+        if "continue" not in data:
+            break
+        continuation = data["continue"]
+
+def select_rendition(info):
+    """Return (url, width, height, mime) of the file to download.
+
+    Uses the server-rendered thumbnail when it is smaller than the original,
+    and the original when the server could not render the requested size.
+    """
+    thumb_url = info.get("thumburl")
+    if thumb_url and info.get("thumbwidth", info["width"]) < info["width"]:
+        thumb_mime = mimetypes.guess_type(thumb_url.split("?")[0])[0] or info["mime"]
+        return thumb_url, info["thumbwidth"], info["thumbheight"], thumb_mime
+    return info["url"], info["width"], info["height"], info["mime"]
+
+def download_image(image_info, category, output_dir, handled=()):
+    """Download a file and write its metadata.
+
+    handled holds the pageids already saved or recorded in the current
+    category-tree crawl. Returns True when saved, False when filtered out, or
+    DUPLICATE when the same file was already downloaded, for another category
+    or earlier in this crawl.
+    """
+    info = image_info['imageinfo'][0]
+    image_name = info['url'].split("/")[-1]
+    image_url, width, height, image_format = select_rendition(info)
+
+    title_no_prefix = title_without_prefix(image_info["title"])
 
     # Check for English title
-    if not is_english_title(title_no_prefix):
+    is_english = image_info.get("is_english")
+    if is_english is None:
+        is_english = language_filter.is_english_title(title_no_prefix)
+    if not is_english:
         logging.info(f"Skipping non-English title: {title_no_prefix}")
         return False
     
@@ -53,71 +240,147 @@ def download_image(image_info, category, output_dir):
         logging.info(f"Skipping non-image file: {title_no_prefix} with MIME type {image_mime}")
         return False
 
-    # Ensure proper file extension handling
-    image_extension = os.path.splitext(image_name)[1]
+    # Ensure proper file extension handling, thumbnails of TIFF/SVG files come back as JPEG/PNG
+    image_extension = os.path.splitext(image_url.split("?")[0])[1]
     if not image_extension:
         image_extension = ".jpg"
-        image_name += image_extension
+    image_name = os.path.splitext(image_name)[0] + image_extension
 
     base_name, _ = os.path.splitext(image_name)
     category_dir = os.path.join(output_dir, category.replace(" ", "_"))
     os.makedirs(category_dir, exist_ok=True)
     file_path = os.path.join(category_dir, image_name)
+    metadata_path = os.path.join(category_dir, f"{base_name}.json")
 
-    # Download and save image
-    img_response = requests.get(image_url, headers=headers, stream=True)
-    img_response.raise_for_status()
+    categories = [category]
+    found_in = image_info.get("found_in", category)
+    if found_in != category:
+        categories.append(found_in)
+
+    sha1 = info.get("sha1")
+
+    # Same file reached again in this crawl through another subcategory
+    if image_info["pageid"] in handled:
+        existing = (lookup_hash(sha1) if sha1 else None) or metadata_path
+        record_duplicate(sha1, existing, categories)
+        logging.info(f"Recorded {found_in} for {existing}: {title_no_prefix}")
+        return DUPLICATE
+
+    # Same file already downloaded for another category: record, don't download
+    if sha1:
+        existing = claim_hash(sha1, metadata_path)
+        if existing == metadata_path and sha1 in _indexed_hashes:
+            # Saved for this category by an earlier run
+            return True
+        if existing is not None:
+            record_duplicate(sha1, existing, categories)
+            logging.info(f"Recorded duplicate of {existing}: {title_no_prefix}")
+            return DUPLICATE
 
-    with open(file_path, 'wb') as file:
-        for chunk in img_response.iter_content(chunk_size=8192):
-            file.write(chunk)
+    # Download and save image
+    try:
+        img_response = http_client.get(image_url, stream=True)
+        img_response.raise_for_status()
+        image_io.stream_to_file(img_response, file_path)
+    except Exception:
+        if sha1:
+            release_hash(sha1, metadata_path)
+        raise
 
     # Metadata structure
     metadata = {
         "title": title_no_prefix,
         "url": image_url,
         "document_type": "wikimedia_commons",
-        "categories": [category],
+        "categories": categories,
         "source": {
             "provider": "Wikimedia Commons",
             "repository": "commons.wikimedia.org"
         },
         "retrieved_date": datetime.today().strftime('%Y-%m-%d'),
         "additional_info": {
-            "resolution": f"{image_info['imageinfo'][0]['width']}x{image_info['imageinfo'][0]['height']}",
-            "format": image_info['imageinfo'][0]['mime']
+            "resolution": f"{width}x{height}",
+            "format": image_format,
+            "sha1": sha1
         }
     }
+    if image_url != info['url']:
+        metadata["additional_info"]["original_url"] = info['url']
+        metadata["additional_info"]["original_resolution"] = f"{info['width']}x{info['height']}"
 
     # Save metadata
-    metadata_path = os.path.join(category_dir, f"{base_name}.json")
-    with open(metadata_path, 'w') as json_file:
-        json.dump(metadata, json_file, indent=4)
+    try:
+        if sha1:
+            write_downloaded_metadata(sha1, metadata_path, metadata)
+        else:
+            catalog.write_metadata(metadata_path, metadata)
+    except Exception:
+        if sha1:
+            release_hash(sha1, metadata_path)
+        raise
 
     logging.info(f"Downloaded and saved: {title_no_prefix}")
 
     return True
 
-def download_wikimedia_images(categories, max_images_per_category, output_dir):
+def download_category_images(category, max_images_per_category, output_dir, target_max_side=None, crawl_depth=0, max_subcategories=50):
+    logging.info(f"Processing category: {category}")
+    downloaded = 0
+    # Pageids saved or recorded in this crawl; subcategories often list the same files
+    handled = set()
+
+    try:
+        for image_info in iter_category_tree_images(category, target_max_side, crawl_depth, max_subcategories):
+            job_id = f"{category}/{image_info['title']}"
+
+            if image_info["pageid"] in handled:
+                # Only records the subcategory it was found in again
+                try:
+                    download_image(image_info, category, output_dir, handled)
+                except Exception as e:
+                    logging.error(f"Error recording {image_info['title']}: {e}")
+            # Files finished in an earlier run still count towards the quota
+            elif job_ledger.get_status(LEDGER_SOURCE, job_id) == job_ledger.DONE:
+                downloaded += 1
+                handled.add(image_info["pageid"])
+            elif job_ledger.should_run(LEDGER_SOURCE, job_id):
+                job_ledger.mark_pending(LEDGER_SOURCE, job_id)
+                try:
+                    success = download_image(image_info, category, output_dir, handled)
+                    if success:
+                        handled.add(image_info["pageid"])
+                    if success == DUPLICATE:
+                        # Not a new image, so it does not count towards the quota
+                        job_ledger.mark_skipped(LEDGER_SOURCE, job_id)
+                    elif success:
+                        downloaded += 1
+                        job_ledger.mark_done(LEDGER_SOURCE, job_id)
+                        logging.info(f"Downloaded and saved metadata: {image_info['title']}")
+                    else:
+                        job_ledger.mark_skipped(LEDGER_SOURCE, job_id)
+                except Exception as e:
+                    job_ledger.mark_failed(LEDGER_SOURCE, job_id, e)
+                    logging.error(f"Error downloading {image_info['title']}: {e}")
+
+            if downloaded >= max_images_per_category:
+                break
+    except Exception as e:
+        logging.error(f"Error listing category '{category}': {e}")
+
+    logging.info(f"Finished category '{category}': downloaded {downloaded} images.")
+    return downloaded
+
+def download_wikimedia_images(categories, max_images_per_category, output_dir, max_workers=1, target_max_side=None, crawl_depth=0, max_subcategories=50):
     logging.info("Starting Wikimedia Commons image retrieval...")
     os.makedirs(output_dir, exist_ok=True)
+    load_hash_index(output_dir)
 
-    for category in categories:
-        logging.info(f"Processing category: {category}")
-        images = search_images(category, limit=max_images_per_category)
-        downloaded = 0
-
-        for image_info in images:
-            try:
-                success = download_image(image_info, category, output_dir)
-                if success:
-                    downloaded += 1
-                    logging.info(f"Downloaded and saved metadata: {image_info['title']}")
-                if downloaded >= max_images_per_category:
-                    break
-            except Exception as e:
-                logging.error(f"Error downloading {image_info['title']}: {e}")
-
-        logging.info(f"Finished category '{category}': downloaded {downloaded} images.")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_category_images, category, max_images_per_category, output_dir, target_max_side, crawl_depth, max_subcategories)
+            for category in categories
+        ]
+        downloaded = sum(future.result() for future in futures)
 
-    logging.info("Completed Wikimedia Commons image retrieval.")
\ No newline at end of file
+    logging.info(f"Completed Wikimedia Commons image retrieval: {downloaded} images.")
+    return downloaded
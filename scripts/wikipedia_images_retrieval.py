@@ -1,65 +1,210 @@
 import os
+import re
 import json
-import requests
-from bs4 import BeautifulSoup
-from PIL import Image, ImageFile
-from io import BytesIO
+from itertools import islice
+from urllib.parse import unquote
 from datetime import datetime
 from tqdm import tqdm
+import queue
+import threading
 import logging
+from scripts import catalog, html_extract, http_client, image_io, job_ledger
 
-# Allow truncated images
-ImageFile.LOAD_TRUNCATED_IMAGES = True
+LEDGER_SOURCE = "wikipedia"
 
-# Headers compliant with Wikipedia policy
-headers = {
-    "User-Agent": "mAiEnergyBot/1.0 (kosmylo@gmail.com; downloading images from Wikipedia for research project)"
-}
+WIKIPEDIA_API_ENDPOINT = "https://en.wikipedia.org/w/api.php"
 
-def read_wiki_json(input_file):
+# Titles per MediaWiki API request
+API_BATCH_SIZE = 50
+
+# prop=images lists every file on a page, template icons included. Only photos and
+# other bitmaps at least this large on both sides are taken as article images; the
+# HTML scraper's figure thumbnails are rarely smaller
+MIN_API_IMAGE_SIDE = 200
+ARTICLE_IMAGE_MIMES = {"image/jpeg", "image/png", "image/tiff", "image/webp"}
+
+# Width of Wikipedia's default article thumbnails, which the HTML scraper downloads.
+# The API asks for this rendition too unless a target_max_side is set
+DEFAULT_THUMB_WIDTH = 220
+
+# .../thumb/<hash path>/<file>/<width>px-<file or rendition name>
+THUMB_URL_PATTERN = re.compile(r"^(?P<prefix>.+/thumb/[0-9a-f]/[0-9a-f]{2})/(?P<file>[^/]+)/\d+px-(?P<suffix>[^/]+)$")
+
+def iter_wiki_articles(input_file):
+    """Lazily yield the title and URL of each article, dropping the article text."""
     with open(input_file, 'r', encoding='utf-8') as f:
-        return [json.loads(line) for line in f]
+        for line in f:
+            if not line.strip():
+                continue
+            article = json.loads(line)
+            yield {"title": article.get("title"), "url": article.get("url")}
 
-def get_article_images_with_captions(article_url):
-    response = requests.get(article_url, headers=headers)
-    response.raise_for_status()
-    soup = BeautifulSoup(response.content, 'html.parser')
+def largest_srcset_url(srcset):
+    """Pick the highest-density candidate of an img srcset attribute."""
+    candidates = []
+    for candidate in srcset.split(","):
+        parts = candidate.strip().split()
+        if not parts:
+            continue
+        density = parts[1] if len(parts) > 1 else "1x"
+        try:
+            candidates.append((float(density.rstrip("xw")), parts[0]))
+        except ValueError:
+            continue
+    return max(candidates)[1] if candidates else None
 
+def target_image_url(img_tag, img_url, target_max_side):
+    """Rewrite a Wikipedia thumbnail URL so its longest side is target_max_side.
+
+    Thumbnail URLs look like .../thumb/a/ab/Name.jpg/220px-Name.jpg. The
+    original is returned when it is already smaller than the target, since the
+    thumbnailer does not upscale raster images.
+    """
+    match = THUMB_URL_PATTERN.match(img_url)
+    if not match:
+        return img_url
+
+    try:
+        file_width = int(img_tag.get('data-file-width'))
+        file_height = int(img_tag.get('data-file-height'))
+    except (TypeError, ValueError):
+        srcset_url = largest_srcset_url(img_tag.get('srcset', ''))
+        return normalize_image_url(srcset_url) if srcset_url else img_url
+
+    prefix, file_name, suffix = match.group("prefix"), match.group("file"), match.group("suffix")
+    scale = target_max_side / max(file_width, file_height)
+    if scale >= 1 and not file_name.lower().endswith(".svg"):
+        return prefix.replace("/thumb/", "/", 1) + "/" + file_name
+
+    target_width = max(1, round(file_width * scale))
+    return f"{prefix}/{file_name}/{target_width}px-{suffix}"
+
+def normalize_image_url(img_src):
+    if img_src.startswith("//"):
+        return "https:" + img_src
+    elif img_src.startswith("/"):
+        return "https://en.wikipedia.org" + img_src
+    return img_src
+
+def get_article_images_with_captions(article_url, target_max_side=None):
+    response = http_client.get(article_url)
+    response.raise_for_status()
     images_data = []
 
     # Extract images within figures or divs with captions
-    for figure in soup.select('.mw-parser-output figure, .mw-parser-output div.thumb'):
-        img_tag = figure.find('img')
-        if not img_tag:
-            continue
-
+    for img_tag, caption in html_extract.wikipedia_figures(response.content, response.headers.get("Content-Type")):
         # Get complete image URL
         img_src = img_tag.get('src')
         if not img_src:
             continue
 
-        if img_src.startswith("//"):
-            img_url = "https:" + img_src
-        elif img_src.startswith("/"):
-            img_url = "https://en.wikipedia.org" + img_src
-        else:
-            img_url = img_src
-
-        # Get caption
-        caption_tag = figure.find('figcaption') or figure.find('div', class_='thumbcaption')
-        caption = caption_tag.get_text(strip=True) if caption_tag else ""
+        img_url = normalize_image_url(img_src)
+        if target_max_side:
+            img_url = target_image_url(img_tag, img_url, target_max_side)
 
         images_data.append({"img_url": img_url, "caption": caption})
 
     return images_data
 
+def query_api(params):
+    """Yield each response of a MediaWiki query, following continuation."""
+    params = {"action": "query", "format": "json", "formatversion": 2, **params}
+    continuation = {}
+    while True:
+        response = http_client.get(WIKIPEDIA_API_ENDPOINT, params={**params, **continuation})
+        response.raise_for_status()
+        data = response.json()
+        yield data
+        if "continue" not in data:
+            break
+        continuation = data["continue"]
+
+def article_title_from_url(url, fallback):
+    if url and "/wiki/" in url:
+        return unquote(url.split("/wiki/", 1)[1].split("#")[0]).replace("_", " ")
+    return fallback
+
+def is_article_image(info):
+    # Drawings (SVG icons, logos, navbox symbols, maps) and animated GIFs are not article photos
+    if info.get("mediatype") != "BITMAP" or info.get("mime") not in ARTICLE_IMAGE_MIMES:
+        return False
+    return info.get("width", 0) >= MIN_API_IMAGE_SIDE and info.get("height", 0) >= MIN_API_IMAGE_SIDE
+
+def image_caption(info):
+    description = info.get("extmetadata", {}).get("ImageDescription", {}).get("value", "")
+    return html_extract.fragment_text(description, " ")
+
+def get_batch_images_via_api(articles, target_max_side=None):
+    """Resolve images for up to API_BATCH_SIZE articles through the MediaWiki API.
+
+    Unlike the HTML scraper, which takes the figures of the article body with
+    their captions, prop=images lists every file used on the page, including
+    infobox and template images. Only bitmaps passing is_article_image are
+    kept, and captions are the files' Commons descriptions. Like the scraper,
+    it downloads DEFAULT_THUMB_WIDTH px thumbnails unless target_max_side is set.
+
+    Returns a dict of article URL -> images_data. Pages the API could not
+    resolve map to None and are left to the HTML scraper.
+    """
+    titles = {article_title_from_url(article["url"], article["title"]): article["url"] for article in articles}
+
+    # Page title -> file titles, following normalisation and redirects
+    resolved = {}
+    page_files = {}
+    for data in query_api({"titles": "|".join(titles), "prop": "images", "imlimit": "max", "redirects": 1}):
+        query = data.get("query", {})
+        for mapping in query.get("normalized", []) + query.get("redirects", []):
+            resolved[mapping["from"]] = mapping["to"]
+        for page in query.get("pages", []):
+            if page.get("missing") or page.get("invalid"):
+                continue
+            page_files.setdefault(page["title"], []).extend(image["title"] for image in page.get("images", []))
+
+    # File title -> imageinfo, batched
+    file_titles = sorted({file_title for files in page_files.values() for file_title in files})
+    file_info = {}
+    for i in range(0, len(file_titles), API_BATCH_SIZE):
+        params = {
+            "titles": "|".join(file_titles[i:i + API_BATCH_SIZE]),
+            "prop": "imageinfo",
+            "iiprop": "url|size|mime|mediatype|extmetadata",
+            "iiextmetadatafilter": "ImageDescription"
+        }
+        if target_max_side:
+            params["iiurlwidth"] = target_max_side
+            params["iiurlheight"] = target_max_side
+        else:
+            params["iiurlwidth"] = DEFAULT_THUMB_WIDTH
+        for data in query_api(params):
+            for page in data.get("query", {}).get("pages", []):
+                if page.get("imageinfo"):
+                    file_info[page["title"]] = page["imageinfo"][0]
+
+    results = {}
+    for title, url in titles.items():
+        for _ in range(3):  # normalised -> redirect target
+            title = resolved.get(title, title)
+
+        images_data = []
+        for file_title in page_files.get(title, []):
+            info = file_info.get(file_title)
+            if info and is_article_image(info):
+                # Server-rendered thumbnail when smaller than the original
+                if info.get("thumburl") and info.get("thumbwidth", info["width"]) < info["width"]:
+                    img_url = info["thumburl"]
+                else:
+                    img_url = info["url"]
+                images_data.append({"img_url": img_url, "caption": image_caption(info)})
+        results[url] = images_data or None
+
+    return results
+
 def download_image(img_url):
-    response = requests.get(img_url, headers=headers)
+    response = http_client.get(img_url, stream=True)
     response.raise_for_status()
-    img = Image.open(BytesIO(response.content))
-    return img
+    return response
 
-def save_image_and_metadata(article_title, img, img_url, caption, output_dir):
+def save_image_and_metadata(article_title, response, img_url, caption, output_dir, convert_to=None):
     sanitized_title = article_title.replace(' ', '_').replace('/', '_')
     img_name = os.path.basename(img_url.split("?")[0])
     base_name, ext = os.path.splitext(img_name)
@@ -68,11 +213,11 @@ def save_image_and_metadata(article_title, img, img_url, caption, output_dir):
     filename = f"{sanitized_title}_{base_name}{ext}"
     img_path = os.path.join(output_dir, filename)
 
-    # Save image
-    img.save(img_path)
+    # Save image bytes as downloaded, reading the size from the header
+    img_path, width, height, image_format = image_io.save_image(response, img_path, convert_to)
+    filename = os.path.basename(img_path)
 
     # Create metadata
-    width, height = img.size
     metadata = {
         "filename": filename,
         "article_title": article_title,
@@ -81,7 +226,7 @@ def save_image_and_metadata(article_title, img, img_url, caption, output_dir):
         "retrieved_date": datetime.today().strftime('%Y-%m-%d'),
         "additional_info": {
             "resolution": f"{width}x{height}px",
-            "image_format": img.format
+            "image_format": image_format
         },
         "source": {
             "provider": "Wikipedia",
@@ -91,33 +236,150 @@ def save_image_and_metadata(article_title, img, img_url, caption, output_dir):
 
     # Save metadata JSON
     metadata_path = os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.json")
-    with open(metadata_path, 'w', encoding='utf-8') as meta_file:
-        json.dump(metadata, meta_file, indent=4)
+    catalog.write_metadata(metadata_path, metadata)
 
-def download_wikipedia_images(input_file, output_dir):
-    logging.info(f"Starting Wikipedia images retrieval from: {input_file}")
+class ArticleJob:
+    """Tracks the images of one article across the download stage."""
 
-    os.makedirs(output_dir, exist_ok=True)
-    articles = read_wiki_json(input_file)
+    def __init__(self, title, url, image_count):
+        self.title = title
+        self.url = url
+        self.remaining = image_count
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def finish_image(self, error=None):
+        with self.lock:
+            if error:
+                self.errors.append(error)
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.record()
+
+    def record(self):
+        if self.errors:
+            job_ledger.mark_failed(LEDGER_SOURCE, self.url, "; ".join(self.errors))
+        else:
+            job_ledger.mark_done(LEDGER_SOURCE, self.url)
+
+def queue_article_images(article, discovered, image_queue, target_max_side):
+    """Find the images of one article and queue them for download."""
+    title = article.get("title")
+    url = article.get("url")
 
-    for article in tqdm(articles, desc="Processing Wikipedia articles"):
-        title = article.get("title")
-        url = article.get("url")
+    images_data = discovered.get(url)
+    if images_data is None:
+        try:
+            images_data = get_article_images_with_captions(url, target_max_side)
+        except Exception as e:
+            job_ledger.mark_failed(LEDGER_SOURCE, url, e)
+            logging.error(f"Failed to process article '{title}' ({url}): {e}")
+            return
+
+    job = ArticleJob(title, url, len(images_data))
+    if not images_data:
+        job.record()
+    for img_data in images_data:
+        image_queue.put((job, img_data))
+
+def article_worker(article_queue, image_queue, progress, discovery, target_max_side):
+    # A failure never ends the loop: a dead worker would leave the producer blocked on the full queue
+    while True:
+        batch = article_queue.get()
+        if batch is None:
+            break
 
         try:
-            images_data = get_article_images_with_captions(url)
-            for img_data in images_data:
-                img_url = img_data["img_url"]
-                caption = img_data["caption"]
+            pending = [article for article in batch if job_ledger.should_run(LEDGER_SOURCE, article.get("url"))]
+            for article in pending:
+                job_ledger.mark_pending(LEDGER_SOURCE, article.get("url"))
 
+            discovered = {}
+            if discovery == "api" and pending:
                 try:
-                    img = download_image(img_url)
-                    save_image_and_metadata(title, img, img_url, caption, output_dir)
-                    logging.info(f"Downloaded and saved image from '{title}'")
+                    discovered = get_batch_images_via_api(pending, target_max_side)
                 except Exception as e:
-                    logging.error(f"Failed to download/save image {img_url}: {e}")
+                    logging.warning(f"MediaWiki API discovery failed, falling back to HTML: {e}")
 
+            for article in pending:
+                try:
+                    queue_article_images(article, discovered, image_queue, target_max_side)
+                except Exception as e:
+                    logging.error(f"Failed to queue images of article '{article.get('title')}': {e}")
         except Exception as e:
-            logging.error(f"Failed to process article '{title}' ({url}): {e}")
+            logging.error(f"Failed to process a batch of {len(batch)} articles: {e}")
+        finally:
+            progress.update(len(batch))
+
+def image_worker(image_queue, output_dir, counter, convert_to):
+    # As for article_worker, every item is handled whatever fails
+    while True:
+        item = image_queue.get()
+        if item is None:
+            break
+
+        job, img_data = item
+        img_url = img_data["img_url"]
+        error = None
+        try:
+            response = download_image(img_url)
+            save_image_and_metadata(job.title, response, img_url, img_data["caption"], output_dir, convert_to)
+            with counter["lock"]:
+                counter["downloaded"] += 1
+            logging.info(f"Downloaded and saved image from '{job.title}'")
+        except Exception as e:
+            logging.error(f"Failed to download/save image {img_url}: {e}")
+            error = f"{img_url}: {e}"
+
+        try:
+            job.finish_image(error)
+        except Exception as e:
+            logging.error(f"Failed to record the result of article '{job.title}': {e}")
+
+def download_wikipedia_images(input_file, output_dir, max_workers=1, download_workers=None, queue_size=100, discovery="html", convert_to=None, target_max_side=None):
+    logging.info(f"Starting Wikipedia images retrieval from: {input_file}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    download_workers = download_workers or max_workers
+
+    # Bounded queues keep memory flat: articles -> page parsing -> image downloads
+    article_queue = queue.Queue(maxsize=queue_size)
+    image_queue = queue.Queue(maxsize=queue_size)
+    counter = {"downloaded": 0, "lock": threading.Lock()}
+    progress = tqdm(desc="Processing Wikipedia articles")
+
+    article_threads = [
+        threading.Thread(target=article_worker, args=(article_queue, image_queue, progress, discovery, target_max_side), daemon=True)
+        for _ in range(max_workers)
+    ]
+    image_threads = [
+        threading.Thread(target=image_worker, args=(image_queue, output_dir, counter, convert_to), daemon=True)
+        for _ in range(download_workers)
+    ]
+    for thread in article_threads + image_threads:
+        thread.start()
+
+    # The API resolves whole batches of titles, the HTML scraper one page at a time
+    batch_size = API_BATCH_SIZE if discovery == "api" else 1
+    articles = iter_wiki_articles(input_file)
+
+    try:
+        while True:
+            batch = list(islice(articles, batch_size))
+            if not batch:
+                break
+            article_queue.put(batch)
+    finally:
+        for _ in article_threads:
+            article_queue.put(None)
+        for thread in article_threads:
+            thread.join()
+        for _ in image_threads:
+            image_queue.put(None)
+        for thread in image_threads:
+            thread.join()
+        progress.close()
 
-    logging.info("Completed Wikipedia image retrieval.")
\ No newline at end of file
+    downloaded = counter["downloaded"]
+    logging.info(f"Completed Wikipedia image retrieval: {downloaded} images.")
+    return downloaded
@@ -0,0 +1,61 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pytest
+from scripts import eprel_retrieval
+
+# 7 mock ovens, listed 3 per page
+OVENS = [{"eprelRegistrationNumber": 1000 + number, "supplierOrTrademark": "Acme", "modelIdentifier": f"OV{number}"} for number in range(7)]
+
+class ListingHandler(BaseHTTPRequestHandler):
+    requests_seen = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.requests_seen.append((url.path, query))
+        page, limit = int(query["_page"]), int(query["_limit"])
+        hits = OVENS[(page - 1) * limit:page * limit] if url.path == "/api/products/ovens" else []
+        body = json.dumps({"hits": hits}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def listing_url():
+    ListingHandler.requests_seen = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ListingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/api/products"
+    server.shutdown()
+    server.server_close()
+
+def test_listing_pages_until_a_short_page(listing_url):
+    products = list(eprel_retrieval.iter_listed_products("ovens", listing_url, page_size=3))
+
+    assert [product_id for _, product_id, _ in products] == [hit["eprelRegistrationNumber"] for hit in OVENS]
+    assert products[0] == ("ovens", 1000, "Acme OV0")
+    assert [query["_page"] for _, query in ListingHandler.requests_seen] == ["1", "2", "3"]
+
+def test_listing_sends_filters_on_every_page(listing_url):
+    list(eprel_retrieval.iter_listed_products("ovens", listing_url, filters={"energyClass": "A"}, page_size=3))
+
+    assert ListingHandler.requests_seen
+    assert all(query["energyClass"] == "A" and query["_limit"] == "3" for _, query in ListingHandler.requests_seen)
+
+def test_listing_stops_at_max_products(listing_url):
+    products = list(eprel_retrieval.iter_listed_products("ovens", listing_url, max_products=4, page_size=3))
+
+    assert [product_id for _, product_id, _ in products] == [1000, 1001, 1002, 1003]
+    assert len(ListingHandler.requests_seen) == 2
+
+def test_download_rejects_empty_queue(tmp_path):
+    with pytest.raises(ValueError):
+        eprel_retrieval.download_eprel_labels(str(tmp_path), queue_size=0)
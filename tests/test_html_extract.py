@@ -0,0 +1,19 @@
+import pytest
+from benchmarks.bench_html_extract import SAMPLE_PAGES, baseline_nasa, baseline_wikipedia
+from scripts import html_extract
+
+@pytest.mark.parametrize("page", SAMPLE_PAGES["nasa"])
+def test_nasa_article_matches_beautifulsoup(page):
+    assert html_extract.nasa_article(page.encode("utf-8")) == baseline_nasa(page.encode("utf-8"))
+
+@pytest.mark.parametrize("page", SAMPLE_PAGES["wikipedia"])
+def test_wikipedia_figures_match_beautifulsoup(page):
+    assert html_extract.wikipedia_figures(page.encode("utf-8")) == baseline_wikipedia(page.encode("utf-8"))
+
+def test_non_ascii_text_is_decoded():
+    article = html_extract.nasa_article(SAMPLE_PAGES["nasa"][-1].encode("utf-8"))
+    assert article["title"] == "Canicule sur l’Île-de-France – 40 °C"
+
+def test_content_type_charset_takes_precedence():
+    page = "<html><body><h1>Zürich</h1></body></html>".encode("cp1252")
+    assert html_extract.nasa_article(page, "text/html; charset=windows-1252")["title"] == "Zürich"
@@ -0,0 +1,48 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from scripts import phash_index
+
+def make_image(directory, stem, seed, size=(64, 64)):
+    os.makedirs(directory, exist_ok=True)
+    pixels = np.random.default_rng(seed).integers(0, 256, (8, 8), dtype=np.uint8)
+    image_path = os.path.join(directory, stem + ".png")
+    Image.fromarray(pixels).resize(size, Image.NEAREST).save(image_path)
+    with open(os.path.join(directory, stem + ".json"), 'w', encoding='utf-8') as json_file:
+        json.dump({"title": stem}, json_file)
+    return image_path
+
+def read_flag(image_path):
+    with open(os.path.splitext(image_path)[0] + ".json", encoding='utf-8') as json_file:
+        return json.load(json_file).get("additional_info", {}).get("near_duplicate_of")
+
+def test_dedupe_queries_only_new_images(tmp_path):
+    root = str(tmp_path / "images")
+    index_path = str(tmp_path / "index.json")
+    report_path = str(tmp_path / "report.json")
+    make_image(os.path.join(root, "nasa"), "a", seed=1, size=(128, 128))
+    copy = make_image(os.path.join(root, "wikipedia"), "a_copy", seed=1)
+    make_image(os.path.join(root, "nasa"), "b", seed=2)
+
+    assert phash_index.dedupe_images(root, index_path, action="flag", report_path=report_path, max_workers=1) == 1
+    assert read_flag(copy) == os.path.join("nasa", "a.png")
+
+    # Nothing new: the flagged copy is neither queried nor rewritten
+    mtime = os.path.getmtime(os.path.splitext(copy)[0] + ".json")
+    assert phash_index.dedupe_images(root, index_path, action="flag", report_path=report_path, max_workers=1) == 0
+    assert os.path.getmtime(os.path.splitext(copy)[0] + ".json") == mtime
+
+    # A new download only matches the unflagged original
+    late = make_image(os.path.join(root, "wikimedia"), "a_late", seed=1, size=(32, 32))
+    assert phash_index.dedupe_images(root, index_path, action="flag", report_path=report_path, max_workers=1) == 1
+    assert read_flag(late) == os.path.join("nasa", "a.png")
+
+def test_check_image_matches_indexed_copy(tmp_path):
+    root = str(tmp_path / "images")
+    make_image(root, "a", seed=1)
+    make_image(root, "b", seed=2)
+    entries, new_paths = phash_index.update_index(root, str(tmp_path / "index.json"), max_workers=1)
+    assert sorted(new_paths) == ["a.png", "b.png"]
+    candidate = make_image(str(tmp_path / "new"), "candidate", seed=1, size=(200, 200))
+    assert phash_index.check_image(candidate, entries, phash_index.build_tree(entries)) == ["a.png"]
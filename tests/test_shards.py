@@ -0,0 +1,50 @@
+import os
+import json
+import tarfile
+from scripts import shards
+
+def make_sample(directory, stem, data):
+    os.makedirs(directory, exist_ok=True)
+    image_path = os.path.join(directory, stem + ".jpg")
+    with open(image_path, 'wb') as image_file:
+        image_file.write(data)
+    with open(os.path.join(directory, stem + ".json"), 'w', encoding='utf-8') as json_file:
+        json.dump({"title": stem}, json_file)
+    return image_path
+
+def read_members(shards_dir):
+    members = {}
+    for name in sorted(os.listdir(shards_dir)):
+        if name.endswith(".tar"):
+            with tarfile.open(os.path.join(shards_dir, name)) as tar:
+                for member in tar.getmembers():
+                    assert member.isfile(), member.name
+                    members[member.name] = tar.extractfile(member).read()
+    return members
+
+def test_pack_shards_stores_symlinked_image_bytes(tmp_path):
+    dataset = tmp_path / "dataset"
+    root = tmp_path / "images"
+    source = make_sample(str(dataset), "tile1", b"image bytes")
+    os.makedirs(root / "inria")
+    os.symlink(source, root / "inria" / "tile1.jpg")
+    os.symlink(os.path.join(dataset, "tile1.json"), root / "inria" / "tile1.json")
+
+    packed = shards.pack_shards(str(root), str(tmp_path / "shards"), max_workers=1)
+
+    assert packed == 1
+    members = read_members(str(tmp_path / "shards"))
+    assert members["inria__tile1.jpg"] == b"image bytes"
+    assert json.loads(members["inria__tile1.json"]) == {"title": "tile1"}
+
+def test_pack_shards_only_packs_new_samples(tmp_path):
+    root = tmp_path / "images"
+    make_sample(str(root / "nasa"), "a", b"a")
+    shards_dir = str(tmp_path / "shards")
+    assert shards.pack_shards(str(root), shards_dir, max_workers=1) == 1
+
+    make_sample(str(root / "nasa"), "b", b"b")
+    assert shards.pack_shards(str(root), shards_dir, max_workers=1) == 1
+
+    index = shards.load_shard_index(shards_dir)
+    assert [shard["keys"] for shard in index["shards"]] == [["nasa__a"], ["nasa__b"]]